@@ -1,12 +1,19 @@
-from sqlalchemy import Column, String, Integer, Text, Boolean, Numeric, func, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Text, Boolean, Numeric, func, DateTime, ForeignKey, Index, \
+    UniqueConstraint, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from tld import get_tld, get_fld
 from tld.exceptions import TldBadUrl, TldDomainNotFound
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+from fnmatch import fnmatchcase
 import requests
 import warnings
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 
 base = declarative_base()
 
@@ -21,9 +28,13 @@ class Scrape(base):
     uid = Column(Integer, primary_key=True)
     created = Column(DateTime, default=func.now())
     url_started = Column(Text, nullable=False)
+    url_started_hash = Column(String(40), index=True)
     url_finished = Column(Text)
+    url_finished_hash = Column(String(40), index=True)
     status_code = Column(Integer)
     seconds_elapsed = Column(Numeric(12, 8), nullable=False)
+    host_uid = Column(Integer, ForeignKey('host.uid'), index=True)
+    host = relationship('Host')
     outlet = relationship('Outlet', back_populates='scrape')
     links_outgoing = relationship(
         'Link',
@@ -64,14 +75,19 @@ class Scrape(base):
     def extract(html, url, parser='lxml'):
         soup = BeautifulSoup(html, parser)
         links = []
+        canonical_urls = set()
         for link in soup.find_all(Scrape.filter_link_tags):
             link = Link.sanitize_url(link.get('href'), base_url=url)
-            if link and link not in links:
-                links.append(link)
+            if link:
+                # variants of the same URL (e.g., with tracking parameters) are only kept once, by their first form
+                canonical_url = Link.canonicalize_url(link)
+                if canonical_url not in canonical_urls:
+                    canonical_urls.add(canonical_url)
+                    links.append(link)
         return links
 
     @staticmethod
-    def request(url, browser_header=None):
+    def request(url, browser_header=None, timeout=None):
         # gangster mode on
         # verify=False bypasses HTTPS certificate verification
         import warnings
@@ -82,7 +98,7 @@ class Scrape(base):
         disable_warnings()
         with warnings.catch_warnings():
             warnings.filterwarnings('ignore', category=InsecureRequestWarning)
-            response = requests.get(url, headers=browser_header, verify=False)
+            response = requests.get(url, headers=browser_header, verify=False, timeout=timeout)
         # gangster mode off
         if response.status_code == 200:
             return response
@@ -91,25 +107,146 @@ class Scrape(base):
             error.response = response
             raise error
 
+    @staticmethod
+    def classify_failure(error):
+        """Returns the failure class of an exception raised by request() along with the number of seconds the
+        server asked us to wait (Retry-After) or None. Failure classes are timeout, dns, connection, rate_limited,
+        server, and client; exceptions outside of these classes (e.g., parsing errors) yield None.
+        """
+        if isinstance(error, ScrapeError):
+            status_code = error.response.status_code
+            if status_code == 429 or status_code == 503:
+                retry_after = Scrape.parse_retry_after(error.response.headers.get('retry-after'))
+                if status_code == 429 or retry_after is not None:
+                    return 'rate_limited', retry_after
+            if status_code == 408:
+                return 'timeout', None
+            return ('server' if status_code >= 500 else 'client'), None
+        if isinstance(error, requests.exceptions.Timeout):
+            return 'timeout', None
+        if isinstance(error, requests.exceptions.ConnectionError):
+            message = str(error)
+            if any(hint in message for hint in (
+                    'Name or service not known', 'getaddrinfo failed', 'nodename nor servname',
+                    'No address associated with hostname', 'Temporary failure in name resolution'
+            )):
+                return 'dns', None
+            return 'connection', None
+        return None, None
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Retry-After may either hold a number of seconds or an HTTP date."""
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                return None
+
+
+class Host(base):
+    __tablename__ = 'host'
+    __table_args__ = {'mysql_charset': 'utf8', 'mysql_collate': 'utf8_general_ci'}
+    uid = Column(Integer, primary_key=True)
+    fld = Column(String(250), unique=True, nullable=False)
+    tld = Column(String(50))
+    country = Column(String(2))
+    outlets = relationship('Outlet', back_populates='host')
+
+    def __repr__(self):
+        return "<Host('%s', tld='%s')>" % (self.fld, self.tld)
+
+    @staticmethod
+    def describe(fld):
+        """Returns the values for a new Host row, incl. top-level domain and (for country-code TLDs) country."""
+        tld = fld.split('.', 1)[1] if '.' in fld else ''
+        country = tld.rsplit('.', 1)[-1]
+        return {
+            'fld': fld,
+            'tld': tld,
+            'country': country.upper() if len(country) == 2 and country.isalpha() else None
+        }
+
+
+class HostRegistry:
+    """Thread-safe cache of Host uids by first-level domain. Unknown hosts are inserted in their own short
+    transaction, so that concurrent scrapers can never roll back each other's scrapes over a duplicate host.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._uids = {}
+        self._lock = threading.Lock()
+
+    def get_uid(self, fld):
+        uid = self._uids.get(fld)
+        if uid is None:
+            with self._lock:
+                uid = self._uids.get(fld)
+                if uid is None:
+                    uid = self._lookup(fld)
+                    if uid is None:
+                        try:
+                            with self._engine.begin() as connection:
+                                connection.execute(Host.__table__.insert(), Host.describe(fld))
+                        except IntegrityError:
+                            # another process inserted this host in the meantime
+                            pass
+                        uid = self._lookup(fld)
+                    self._uids[fld] = uid
+        return uid
+
+    def _lookup(self, fld):
+        with self._engine.connect() as connection:
+            return connection.execute(select([Host.uid]).where(Host.fld == fld)).scalar()
+
 
 class Link(base):
     __tablename__ = 'link'
     __table_args__ = {'mysql_charset': 'utf8', 'mysql_collate': 'utf8_general_ci'}
     uid = Column(Integer, primary_key=True)
-    url_origin = Column(Text, nullable=False)
-    fld_origin = Column(String(250), nullable=False)
+    host_origin_uid = Column(Integer, ForeignKey('host.uid'), index=True, nullable=False)
+    host_origin = relationship(Host, foreign_keys=[host_origin_uid])
     scrape_origin_uid = Column(Integer, ForeignKey('scrape.uid'), nullable=False)
     scrape_origin = relationship(Scrape, back_populates='links_outgoing', foreign_keys=[scrape_origin_uid])
     url_target = Column(Text, nullable=False)
-    fld_target = Column(String(250), nullable=False)
+    url_target_hash = Column(String(40), index=True)
+    host_target_uid = Column(Integer, ForeignKey('host.uid'), index=True, nullable=False)
+    host_target = relationship(Host, foreign_keys=[host_target_uid])
     is_internal = Column(Boolean)
     scrape_target_uid = Column(Integer, ForeignKey('scrape.uid'))
     scrape_target = relationship(Scrape, back_populates='links_incoming', foreign_keys=[scrape_target_uid])
     erroneous_scrapes = Column(Integer, default=0, nullable=False)
+    canonicalization = {
+        'blocklist': ['utm_*', 'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', '_ga', 'igshid', 'yclid',
+                      'ref_src', 'phpsessid', 'jsessionid', 'sessionid', 'session_id', 'aspsessionid*', 'cfid',
+                      'cftoken'],
+        'sort_query': True,
+        'fold_scheme': True,
+        'fold_www': True,
+        'strip_fragment': True,
+        'strip_trailing_slash': True
+    }
 
     def __repr__(self):
         return "<Link(internal='%d', origin='%s', target='%s')>" % (self.is_internal, self.url_origin, self.url_target)
 
+    @property
+    def url_origin(self):
+        return self.scrape_origin.url_finished
+
+    @property
+    def fld_origin(self):
+        return self.host_origin.fld
+
+    @property
+    def fld_target(self):
+        return self.host_target.fld
+
     def increase_errors(self):
         self.erroneous_scrapes = self.erroneous_scrapes + 1
 
@@ -125,6 +262,62 @@ class Link(base):
         except TldBadUrl:
             return ''
 
+    @staticmethod
+    def configure_canonicalization(config):
+        rules = Link.canonicalization
+        blocklist = config.get('Canonical', 'blocklist', fallback='')
+        if blocklist != '':
+            rules['blocklist'] = [parameter.strip().lower() for parameter in blocklist.split(',') if parameter.strip()]
+        for key in ['sort_query', 'fold_scheme', 'fold_www', 'strip_fragment', 'strip_trailing_slash']:
+            rules[key] = config.get('Canonical', key, fallback=('1' if rules[key] else '0')) == '1'
+
+    @staticmethod
+    def canonicalize_url(url):
+        """Reduces variants of the same (sanitized) URL to one form, which serves for deduplication and lookups
+        only (original URLs are stored as they are). Rules are set through configure_canonicalization.
+        """
+        rules = Link.canonicalization
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        if rules['fold_scheme'] and scheme == 'http':
+            scheme = 'https'
+        if rules['fold_www'] and host.startswith('www.'):
+            host = host[4:]
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        if port is not None and port not in (80, 443):
+            host = '%s:%d' % (host, port)
+        path = parts.path
+        if ';' in path:
+            # path parameters such as ;jsessionid=... are subject to the blocklist as well
+            path = ';'.join([path.split(';')[0]] + [
+                parameter for parameter in path.split(';')[1:]
+                if not Link._is_blocked(parameter.split('=')[0])
+            ])
+        if rules['strip_trailing_slash']:
+            path = path.rstrip('/')
+        if path == '':
+            path = '/'
+        query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                 if not Link._is_blocked(key)]
+        if rules['sort_query']:
+            query.sort()
+        fragment = '' if rules['strip_fragment'] else parts.fragment
+        return urlunsplit((scheme, host, path, urlencode(query), fragment))
+
+    @staticmethod
+    def _is_blocked(parameter):
+        parameter = parameter.lower()
+        return any(fnmatchcase(parameter, pattern) for pattern in Link.canonicalization['blocklist'])
+
+    @staticmethod
+    def hash_url(url):
+        """Returns the lookup key of a URL, i.e., the SHA-1 hash of its canonical form."""
+        return hashlib.sha1(Link.canonicalize_url(url).encode('utf8')).hexdigest()
+
     @staticmethod
     def extract_fld(url):
         try:
@@ -132,6 +325,10 @@ class Link(base):
         except TldBadUrl:
             warnings.warn('First-level domain from URL "%s" could not be extracted (bad URL)' % url)
             return ''
+        except TldDomainNotFound:
+            # IP addresses, localhost, and unknown top-level domains
+            warnings.warn('First-level domain from URL "%s" could not be extracted (domain not found)' % url)
+            return ''
 
 
 class Sector(base):
@@ -170,6 +367,8 @@ class Outlet(base):
     longitude = Column(Numeric(11, 8), nullable=True)
     url = Column(Text, nullable=False)
     fld = Column(String(250), index=True, nullable=False)
+    host_uid = Column(Integer, ForeignKey('host.uid'), index=True)
+    host = relationship(Host, back_populates='outlets')
     scrape_uid = Column(Integer, ForeignKey('scrape.uid'))
     scrape = relationship(Scrape, back_populates='outlet')
 
@@ -196,3 +395,41 @@ class Outlet(base):
         if area not in ['Denmark', 'Norway', 'Sweden', 'Næstved', 'Stavanger', 'Karlstad']:
             area = 'Other: ' + area
         return area
+
+
+class QueueEntry(base):
+    __tablename__ = 'queue'
+    __table_args__ = (
+        UniqueConstraint('crawl', 'depth_round', 'content_hash'),
+        Index('ix_queue_claim', 'crawl', 'depth_round', 'done', 'lease_expires'),
+        {'mysql_charset': 'utf8', 'mysql_collate': 'utf8_general_ci'}
+    )
+    uid = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=func.now())
+    crawl = Column(String(50), nullable=False)
+    depth_round = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    content_hash = Column(String(40), nullable=False)
+    fld = Column(String(250), nullable=False)
+    lease_owner = Column(String(100), nullable=True)
+    lease_expires = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    retries = Column(Integer, default=0, nullable=False)
+    done = Column(Boolean, default=False, nullable=False)
+
+    def __repr__(self):
+        return "<QueueEntry('%s', round='%d', done='%d')>" % (self.content, self.depth_round, self.done)
+
+    @staticmethod
+    def hash_content(content):
+        return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+
+class HostSlot(base):
+    __tablename__ = 'host_slot'
+    __table_args__ = {'mysql_charset': 'utf8', 'mysql_collate': 'utf8_general_ci'}
+    fld = Column(String(250), primary_key=True)
+    next_request = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<HostSlot('%s', next_request='%s')>" % (self.fld, self.next_request)
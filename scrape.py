@@ -1,19 +1,50 @@
-from time import time
-from setup import get_config, get_engine, get_database, get_browser_header, send_email
+from time import time, sleep
+from datetime import datetime, timedelta
+from uuid import uuid4
+import os
+import socket
+from setup import get_config, get_engine, get_database, get_browser_header, Notifier, iterate_in_chunks, \
+    get_memory_usage
 import threading
 from queue import Queue
-from database import Outlet, Scrape, Link, ScrapeError
-from sqlalchemy import or_, func
-from statistics import mean, stdev
+from database import Outlet, Scrape, Link, ScrapeError, QueueEntry, HostSlot, HostRegistry
+from sqlalchemy import or_, func, case
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from math import sqrt
+from random import uniform
+from heapq import heappush, heappop
+from itertools import count
+from statistics import mean
+import json
 import sys
 import traceback
+import gc
+import warnings
+import requests
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+from urllib3.connectionpool import InsecureRequestWarning
+from tld import get_fld
+
+
+memory_warning_sent = False
+memory_collected = 0
+host_cache = None
 
 
 class Scraper(threading.Thread):
-    def __init__(self, queue, config, db_engine):
+    def __init__(self, queue, config, db_engine, hosts, controller=None, retries=None):
         threading.Thread.__init__(self)
         self._queue = queue
         self._config = config
+        self._hosts = hosts
+        self._controller = controller
+        self._retries = retries
+        self._timeout = float(config.get('Scraper', 'timeout', fallback=30))
+        self._sample = {}
+        self._failure = None
         # to be thread-safe, we use a fresh scoped session, which gets initiated here
         self._db = get_database(db_engine, do_not_die=True)
         if self._db is None:
@@ -22,12 +53,61 @@ class Scraper(threading.Thread):
     def run(self):
         log('Worker set up', str(threading.get_ident()))
         while True:
+            if self._controller is not None and not self._controller.acquire(blocking=False):
+                if isinstance(self._queue, DatabaseQueue):
+                    # claimed entries are handed back rather than held under their lease while waiting for a slot
+                    self._queue.release_buffer()
+                self._controller.acquire()
+            # the slot is taken before an entry is claimed, so workers waiting for one hold no entries
             content = self._queue.get()
             if content == 'quit':
+                if self._controller is not None:
+                    self._controller.cancel()
+                self._queue.task_done()
                 self._db.close()
                 log('Worker resigns from duties', str(threading.get_ident()))
                 break
-            elif content.startswith('outlet:'):
+            self._sample = None
+            try:
+                self.process(content)
+            except:
+                # the worker stays alive for the next item, and the failed one is acknowledged below anyway, as
+                # waiting for the round to finish (queue.join) would block forever otherwise
+                log('Error Occurred with %s' % content, traceback.format_exc(), True)
+                try:
+                    self._db.rollback()
+                    self._db.expunge_all()
+                except:
+                    log('Worker session could not be reset', traceback.format_exc())
+            finally:
+                if self._controller is not None:
+                    if self._sample is None:
+                        # nothing was fetched (e.g., disallowed by robots.txt or postponed)
+                        self._controller.cancel()
+                    else:
+                        self._controller.release(**self._sample)
+                try:
+                    self._queue.task_done()
+                except:
+                    log('Queue entry could not be acknowledged', traceback.format_exc(), True)
+
+    def process(self, content):
+        """Scrapes a single queue item (i.e., "outlet:uid:url" or "link:uid:url") and schedules a retry on failure."""
+        if host_cache is not None and not host_cache.allowed(content.split(':', 2)[2]):
+            # checked here rather than when queueing, so that robots.txt of new hosts is fetched by all workers in
+            # parallel instead of one after another while the queue is filled
+            log('Disallowed by robots.txt', content)
+            return
+        if host_cache is not None and self._retries is not None and not isinstance(self._queue, DatabaseQueue):
+            # hosts asking for a crawl delay are not requested again before it has passed
+            wait = host_cache.reserve(content.split(':', 2)[2])
+            if wait > 0:
+                self._retries.postpone(content, wait)
+                return
+        self._sample = {'fetch_seconds': None, 'db_seconds': None, 'error': False}
+        self._failure = None
+        try:
+            if content.startswith('outlet:'):
                 (type, id, url) = content.split(':', 2)
                 scrape_tmp = self.scrape(url)
                 if scrape_tmp:
@@ -38,6 +118,22 @@ class Scraper(threading.Thread):
             elif content.startswith('link:'):
                 (type, id, url) = content.split(':', 2)
                 self.scrape(url)
+        finally:
+            # everything worth keeping is committed by now (a failed transaction is rolled back), so all objects
+            # are released to keep the session from growing over the worker's lifetime
+            self._db.rollback()
+            self._db.expunge_all()
+        if self._retries is not None:
+            if self._failure is not None:
+                self._retries.schedule(content, *self._failure)
+            else:
+                self._retries.forget(content)
+        check_memory('Worker %d' % threading.get_ident())
+
+    def _commit(self):
+        t0 = time()
+        self._db.commit()
+        self._sample['db_seconds'] = time() - t0
 
     def scrape(self, url):
         """Requests url and extracts links. A Scrape and several 1:n-linked Link objects are created.
@@ -47,29 +143,35 @@ class Scraper(threading.Thread):
         Returns the new Scrape object or False if an error occured.
         """
         try:
-            response = Scrape.request(url, get_browser_header(self._config))
+            response = Scrape.request(url, get_browser_header(self._config), self._timeout)
+            self._sample['fetch_seconds'] = response.elapsed.total_seconds()
             response_url = Link.sanitize_url(response.url)
             if response_url:
+                fld_origin = Link.extract_fld(response.url)
+                host_origin_uid = self._hosts.get_uid(fld_origin)
                 scrape = Scrape(
                     url_started=url,
+                    url_started_hash=Link.hash_url(url),
                     url_finished=response_url,
+                    url_finished_hash=Link.hash_url(response_url),
                     seconds_elapsed=response.elapsed.total_seconds(),
-                    status_code=response.status_code
+                    status_code=response.status_code,
+                    host_uid=host_origin_uid
                 )
                 links = Scrape.extract(response.text, response_url,
                                        self._config.get('Scraper', 'parser', fallback='lxml'))
                 for target in links:
-                    fld_origin = Link.extract_fld(response.url)
                     fld_target = Link.extract_fld(target)
                     link = Link(
-                        url_origin=response_url,
-                        fld_origin=fld_origin,
+                        host_origin_uid=host_origin_uid,
                         url_target=target,
-                        fld_target=fld_target,
+                        url_target_hash=Link.hash_url(target),
+                        host_target_uid=self._hosts.get_uid(fld_target),
                         is_internal=(fld_origin == fld_target)
                     )
                     scrape_existent = self._db.query(Scrape).filter(
-                        or_(Scrape.url_started == target, Scrape.url_finished == target),
+                        or_(Scrape.url_started_hash == link.url_target_hash,
+                            Scrape.url_finished_hash == link.url_target_hash),
                         Scrape.status_code == 200
                     ).order_by(Scrape.created).first()
                     if scrape_existent is not None:
@@ -77,27 +179,41 @@ class Scraper(threading.Thread):
                     scrape.links_outgoing.append(link)
                 self._db.add(scrape)
                 links_existent = self._db.query(Link).filter(
-                    or_(Link.url_target == scrape.url_started, Link.url_target == scrape.url_finished)
+                    Link.url_target_hash.in_([scrape.url_started_hash, scrape.url_finished_hash])
                 ).all()
                 for link_existent in links_existent:
                     link_existent.scrape_target = scrape
-                self._db.commit()
+                self._commit()
                 return scrape
         except ScrapeError as e:
+            self._sample['fetch_seconds'] = e.response.elapsed.total_seconds()
+            # server errors and rate limiting hint at overload, whereas other status codes are the page's business
+            self._sample['error'] = e.response.status_code >= 500 or e.response.status_code == 429
+            self._failure = Scrape.classify_failure(e)
             self._db.add(Scrape(
                 url_started=url,
+                url_started_hash=Link.hash_url(url),
                 url_finished=e.response.url,
+                url_finished_hash=Link.hash_url(e.response.url),
                 seconds_elapsed=e.response.elapsed.total_seconds(),
-                status_code=e.response.status_code
+                status_code=e.response.status_code,
+                host_uid=self._hosts.get_uid(Link.extract_fld(e.response.url))
             ))
             links_existent = self._db.query(Link).filter(
-                or_(Link.url_target == url, Link.url_target == e.response.url)
+                Link.url_target_hash.in_([Link.hash_url(url), Link.hash_url(e.response.url)])
             ).all()
             for link_existent in links_existent:
                 link_existent.increase_errors()
-            self._db.commit()
+            self._commit()
         except:
+            self._sample['error'] = True
             error = sys.exc_info()
+            (failure, retry_after) = Scrape.classify_failure(error[1])
+            if failure is not None:
+                # network failures are expected with a large number of hosts, so they are retried instead of mailed
+                self._failure = (failure, retry_after)
+                log('%s error with %s' % (failure.capitalize(), url), str(error[1]))
+                return False
             if error is not None and error[0] is not None:
                 log('Error Occurred with %s' % url, ('%s \n\n %s' % (str(error[0]), traceback.format_exc())), True)
             else:
@@ -105,63 +221,849 @@ class Scraper(threading.Thread):
         return False
 
 
-def add_to_queue(queue, object_to_append):
+class HostMetadataCache:
+    """Caches metadata per first-level domain: resolved addresses (for every host name below it) and the parsed
+    robots.txt, including its crawl delay. robots.txt is fetched once per host (and again once expired); DNS
+    results are served from here by wrapping socket.getaddrinfo (see install_resolver). Entries expire after their
+    TTL and the least recently used ones are evicted beyond max_entries. The cache can be saved to and loaded from
+    a JSON file so that it carries over between runs.
+    """
+
+    def __init__(self, config):
+        self._file = config.get('Hosts', 'cache', fallback='host_cache.json')
+        self._respect_robots = config.get('Hosts', 'robots', fallback='1') == '1'
+        self._robots_ttl = float(config.get('Hosts', 'robots_ttl', fallback=86400))
+        self._dns_ttl = float(config.get('Hosts', 'dns_ttl', fallback=3600))
+        self._max_entries = int(config.get('Hosts', 'max_entries', fallback=10000))
+        self._politeness = float(config.get('Hosts', 'politeness', fallback=0))
+        self._timeout = float(config.get('Scraper', 'timeout', fallback=30))
+        self._header = get_browser_header(config)
+        self._user_agent = self._header['user-agent'] or '*'
+        self._entries = OrderedDict()
+        self._parsers = {}
+        self._next_request = {}
+        self._reserved = {}
+        self._fetching = {}
+        self._lock = threading.Lock()
+        self._getaddrinfo = None
+
+    def _entry(self, fld):
+        """Returns the (possibly new) entry for fld, marking it as recently used. Must be called under the lock."""
+        entry = self._entries.get(fld)
+        if entry is None:
+            entry = {'robots': None, 'robots_fetched': 0, 'addresses': {}}
+            self._entries[fld] = entry
+            while len(self._entries) > self._max_entries:
+                (evicted, evicted_entry) = self._entries.popitem(last=False)
+                self._parsers.pop(evicted, None)
+        else:
+            self._entries.move_to_end(fld)
+        return entry
+
+    def _robots(self, url):
+        fld = Link.extract_fld(url)
+        fetching = None
+        while True:
+            with self._lock:
+                entry = self._entry(fld)
+                fresh = time() - entry['robots_fetched'] < self._robots_ttl
+                if fresh and fld in self._parsers:
+                    return self._parsers[fld]
+                robots = entry['robots'] if fresh else None
+                if robots is not None:
+                    break
+                if fld not in self._fetching:
+                    # this thread fetches robots.txt, all others asking for the same host meanwhile wait for it
+                    fetching = threading.Event()
+                    self._fetching[fld] = fetching
+                    break
+                waiting = self._fetching[fld]
+            waiting.wait()
+        fetched = None
+        try:
+            if robots is None:
+                # fetched outside of the lock, as the request itself resolves its host through this cache
+                (robots, fetched) = self._fetch_robots(url)
+            parser = RobotFileParser()
+            parser.parse(robots.splitlines())
+            with self._lock:
+                entry = self._entry(fld)
+                if fetched is not None:
+                    entry['robots'] = robots
+                    entry['robots_fetched'] = fetched
+                self._parsers[fld] = parser
+        finally:
+            if fetching is not None:
+                with self._lock:
+                    del self._fetching[fld]
+                fetching.set()
+        return parser
+
+    def _fetch_robots(self, url):
+        """Returns the robots.txt content (empty, i.e., allowing everything, if there is none) along with the time it
+        counts as fetched. Unreachable hosts are treated alike but asked again after a tenth of the TTL.
+        """
+        parts = urlsplit(url)
+        try:
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', category=InsecureRequestWarning)
+                response = requests.get('%s://%s/robots.txt' % (parts.scheme, parts.netloc), headers=self._header,
+                                        verify=False, timeout=self._timeout)
+            return (response.text if response.status_code == 200 else ''), time()
+        except requests.exceptions.RequestException:
+            return '', time() - 0.9 * self._robots_ttl
+
+    def allowed(self, url):
+        if not self._respect_robots:
+            return True
+        return self._robots(url).can_fetch(self._user_agent, url)
+
+    def crawl_delay(self, url):
+        """Returns the number of seconds to wait between two requests to the URL's host (at least Politeness)."""
+        delay = None
+        if self._respect_robots:
+            delay = self._robots(url).crawl_delay(self._user_agent)
+        return max(float(delay or 0), self._politeness)
+
+    def reserve(self, url):
+        """Reserves the next free request slot of the URL's host and returns the seconds until it (0 for right now).
+        Hosts hand out successive slots, so that each URL is postponed once only; when the URL comes back for its
+        slot, it gets 0 without reserving another one.
+        """
+        delay = self.crawl_delay(url)
+        if delay <= 0:
+            return 0
+        fld = Link.extract_fld(url)
+        with self._lock:
+            now = time()
+            slot = self._reserved.pop(url, None)
+            if slot is None:
+                slot = max(now, self._next_request.get(fld, 0))
+                self._next_request[fld] = slot + delay
+            if slot <= now:
+                return 0
+            self._reserved[url] = slot
+            return slot - now
+
+    def install_resolver(self):
+        """Routes all name resolution of this process (incl. that of requests) through the cache."""
+        if self._getaddrinfo is None:
+            self._getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self.getaddrinfo
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        try:
+            fld = get_fld(host, fix_protocol=True) if isinstance(host, str) else ''
+        except Exception:
+            # IP addresses, localhost, and the like are passed on as they are
+            fld = ''
+        if fld == '':
+            return self._getaddrinfo(host, port, family, type, proto, flags)
+        key = '%s|%s|%d|%d|%d|%d' % (host, port, family, type, proto, flags)
+        with self._lock:
+            cached = self._entry(fld)['addresses'].get(key)
+        if cached is not None and time() - cached[0] < self._dns_ttl:
+            return [(socket.AddressFamily(info[0]), socket.SocketKind(info[1]), info[2], info[3], tuple(info[4]))
+                    for info in cached[1]]
+        addresses = self._getaddrinfo(host, port, family, type, proto, flags)
+        with self._lock:
+            self._entry(fld)['addresses'][key] = [time(), [
+                [int(info[0]), int(info[1]), info[2], info[3], list(info[4])] for info in addresses
+            ]]
+        return addresses
+
+    def load(self):
+        if self._file != '' and os.path.isfile(self._file):
+            with open(self._file) as file:
+                entries = json.load(file)
+            with self._lock:
+                for fld, entry in entries.items():
+                    self._entry(fld).update(entry)
+            log('Host cache loaded', '%d hosts from %s' % (len(self._entries), self._file))
+
+    def save(self):
+        if self._file != '':
+            with self._lock:
+                content = json.dumps(self._entries)
+            with open(self._file, 'w') as file:
+                file.write(content)
+
+
+class RetryScheduler(threading.Thread):
+    """Delay queue for failed scrapes. Failures are retried per failure class (see Scrape.classify_failure) with
+    exponential backoff, jitter, and a maximum number of attempts. Waiting retries are held here rather than in the
+    work queue, so they do not take worker slots away from fresh URLs; once due, they are put back into the queue.
+    With a DatabaseQueue, the queue entry itself is deferred instead (and becomes claimable by any node when due),
+    and retries are counted on the entry.
+    """
+    # failure class: (base delay in seconds, maximum number of retries)
+    policies = {
+        'timeout': (60, 3),
+        'dns': (600, 2),
+        'connection': (60, 3),
+        'rate_limited': (120, 5),
+        'server': (60, 3),
+        'client': (0, 0)
+    }
+
+    def __init__(self, config, queue):
+        threading.Thread.__init__(self, daemon=True)
+        self._queue = queue
+        self._policies = {}
+        for failure, (delay, attempts) in RetryScheduler.policies.items():
+            # configured as "delay, attempts", e.g., "timeout = 60, 3"
+            values = config.get('Retry', failure, fallback='%d, %d' % (delay, attempts)).split(',')
+            self._policies[failure] = (float(values[0]), int(values[1]))
+        self._max_delay = float(config.get('Retry', 'max_delay', fallback=3600))
+        self._attempts = {}
+        self._heap = []
+        self._sequence = count()
+        self._condition = threading.Condition()
+
+    def schedule(self, content, failure, retry_after=None):
+        """Returns whether a retry was scheduled (or False if attempts are exhausted or the class is not retried)."""
+        (delay, max_attempts) = self._policies.get(failure, (0, 0))
+        distributed = isinstance(self._queue, DatabaseQueue)
+        with self._condition:
+            if distributed:
+                # counted on the queue entry rather than here, so that the limit holds across all nodes
+                attempt = self._queue.retries() + 1
+            else:
+                attempt = self._attempts.get(content, 0) + 1
+            if attempt > max_attempts:
+                self._attempts.pop(content, None)
+                if max_attempts > 0:
+                    log('Giving up after %d retries (%s)' % (max_attempts, failure), content)
+                return False
+            if not distributed:
+                self._attempts[content] = attempt
+            if retry_after is not None:
+                # never earlier than the server asked for
+                delay = min(retry_after, self._max_delay) * uniform(1, 1.25)
+            else:
+                delay = min(delay * 2 ** (attempt - 1), self._max_delay) * uniform(0.5, 1.5)
+            if not distributed:
+                heappush(self._heap, (time() + delay, next(self._sequence), content))
+                self._condition.notify_all()
+                return True
+        # outside of the lock, so that workers do not wait for each other's database round-trips
+        self._queue.defer(datetime.utcnow() + timedelta(seconds=delay))
+        return True
+
+    def forget(self, content):
+        """Drops the attempt count of content (e.g., once it has been scraped successfully)."""
+        with self._condition:
+            self._attempts.pop(content, None)
+
+    def reset(self):
+        """Drops all attempt counts, as retries are limited per round (and the same content is queued again)."""
+        with self._condition:
+            self._attempts.clear()
+
+    def postpone(self, content, seconds):
+        """Puts content back into the queue after the given number of seconds (not counting as an attempt)."""
+        with self._condition:
+            heappush(self._heap, (time() + seconds, next(self._sequence), content))
+            self._condition.notify_all()
+
+    def wait_for_pending(self):
+        """Blocks until the next retry has been handed to the queue. Returns False right away if none is waiting."""
+        with self._condition:
+            if len(self._heap) == 0:
+                return False
+            self._condition.wait()
+            return True
+
+    def run(self):
+        with self._condition:
+            while True:
+                if len(self._heap) == 0:
+                    self._condition.wait()
+                elif self._heap[0][0] > time():
+                    self._condition.wait(self._heap[0][0] - time())
+                else:
+                    (due, sequence, content) = heappop(self._heap)
+                    self._queue.put(content)
+                    self._condition.notify_all()
+
+
+class ConcurrencyController:
+    """Limits the number of workers fetching at the same time and adapts this limit at runtime (AIMD).
+    Workers report every fetch (fetch latency, DB commit latency, and whether it failed due to overload). At the
+    end of every interval, the limit is halved if the error rate, the DB commit latency, or the fetch latency (in
+    comparison to the lowest latency seen so far) exceeds its threshold; otherwise, it grows by one as long as
+    throughput does not decline. The limit always stays within the configured bounds.
+    """
+
+    def __init__(self, config, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self._interval = float(config.get('Scraper', 'adaptive_interval', fallback=30))
+        self._max_error_rate = float(config.get('Scraper', 'adaptive_max_error_rate', fallback=0.1))
+        self._max_db_seconds = float(config.get('Scraper', 'adaptive_max_db_seconds', fallback=1))
+        self._max_latency_factor = float(config.get('Scraper', 'adaptive_max_latency_factor', fallback=2))
+        self._condition = threading.Condition()
+        self._active = 0
+        self._baseline_fetch_seconds = None
+        self._last_throughput = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time()
+        self._completed = 0
+        self._errors = 0
+        self._fetch_seconds = []
+        self._db_seconds = []
+
+    def acquire(self, blocking=True):
+        """Takes a slot, waiting for one if blocking. Returns whether a slot was taken."""
+        with self._condition:
+            while self._active >= self.limit:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self._active += 1
+            return True
+
+    def cancel(self):
+        """Gives a slot back without reporting a fetch."""
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def release(self, fetch_seconds=None, db_seconds=None, error=False):
+        with self._condition:
+            self._active -= 1
+            self._completed += 1
+            if error:
+                self._errors += 1
+            if fetch_seconds is not None:
+                self._fetch_seconds.append(fetch_seconds)
+            if db_seconds is not None:
+                self._db_seconds.append(db_seconds)
+            if time() - self._window_start >= self._interval:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+        elapsed = time() - self._window_start
+        throughput = self._completed / elapsed
+        error_rate = self._errors / self._completed
+        fetch_seconds = mean(self._fetch_seconds) if len(self._fetch_seconds) > 0 else None
+        db_seconds = mean(self._db_seconds) if len(self._db_seconds) > 0 else 0
+        if fetch_seconds is not None and (self._baseline_fetch_seconds is None or
+                                          fetch_seconds < self._baseline_fetch_seconds):
+            self._baseline_fetch_seconds = fetch_seconds
+
+        previous = self.limit
+        if error_rate > self._max_error_rate:
+            reason = 'error rate above %.2f' % self._max_error_rate
+        elif db_seconds > self._max_db_seconds:
+            reason = 'DB commits slower than %.2fs' % self._max_db_seconds
+        elif fetch_seconds is not None and \
+                fetch_seconds > self._max_latency_factor * self._baseline_fetch_seconds:
+            reason = 'fetch latency above %.1f times the baseline' % self._max_latency_factor
+        else:
+            reason = None
+        if reason is not None:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self._last_throughput is None or throughput >= self._last_throughput:
+            self.limit = min(self.maximum, self.limit + 1)
+            reason = 'throughput not declining'
+        else:
+            reason = 'throughput declined, holding'
+        log('Concurrency %d -> %d (%s)' % (previous, self.limit, reason),
+            '%.2f scrapes/s, %.0f%% errors, fetch %s, DB %.3fs' % (
+                throughput, 100 * error_rate,
+                ('%.2fs' % fetch_seconds) if fetch_seconds is not None else 'n/a', db_seconds
+            ))
+        self._last_throughput = throughput
+        self._reset_window()
+
+
+class DatabaseQueue:
+    """Drop-in replacement for Queue that shares the frontier among several scrape.py processes (nodes) through the
+    queue table. Entries are claimed in batches under a lease; leases of crashed nodes expire and are reclaimed.
+    As a batch is worked through one entry after another, each lease is renewed when its entry is handed to a worker
+    (and the entry is skipped if another node has reclaimed it in the meantime).
+    Claiming uses SELECT ... FOR UPDATE SKIP LOCKED where the database supports it and an atomic conditional UPDATE
+    otherwise. Before an entry is handed to a worker, its host is reserved in the host_slot table, which keeps
+    per-host politeness global across nodes; entries whose host is busy are put back until the host is free again.
+    Instead of explicit "quit" entries, get() returns "quit" once the round is closed and no entry remains undone.
+    Note that lease and politeness timestamps are taken from the nodes' clocks, which should thus be synchronized.
+    """
+
+    def __init__(self, config, db_engine):
+        # scoped sessions are thread-local, so each worker thread gets its own session from this registry
+        self._db = get_database(db_engine)
+        self._crawl = config.get('Queue', 'crawl', fallback=datetime.utcnow().strftime('%Y-%m-%d'))
+        self._node = config.get('Queue', 'node', fallback='%s-%d' % (socket.gethostname(), os.getpid()))[:60]
+        self._batch = int(config.get('Queue', 'batch', fallback=10))
+        self._lease = timedelta(seconds=int(config.get('Queue', 'lease', fallback=600)))
+        self._politeness = timedelta(seconds=float(config.get('Queue', 'politeness', fallback=1)))
+        self._poll = float(config.get('Queue', 'poll', fallback=5))
+        self._max_attempts = int(config.get('Queue', 'max_attempts', fallback=3))
+        self._skip_locked = config.get(
+            'Queue', 'skip_locked', fallback=('1' if db_engine.dialect.name in ('mysql', 'postgresql') else '0')
+        ) == '1'
+        self._round = 0
+        self._pending = {}
+        self._closed = threading.Event()
+        self._local = threading.local()
+
+    def start_round(self, depth_round):
+        self._round = depth_round
+        self._closed.clear()
+
+    def close_round(self):
+        """Stores all remaining entries and lets workers resign as soon as the round is done on all nodes."""
+        self.flush()
+        self._closed.set()
+
+    def put(self, content):
+        if content != 'quit':
+            # entries are identified by type and canonical URL, so that each page is only queued once per round
+            (type, id, url) = content.split(':', 2)
+            self._pending[QueueEntry.hash_content('%s:%s' % (type, Link.canonicalize_url(url)))] = content
+            if len(self._pending) >= 1000:
+                self.flush()
+
+    def flush(self):
+        """Inserts all pending entries in bulk, skipping those already queued (by any node) for this round."""
+        if len(self._pending) == 0:
+            return
+        existing = set(content_hash for (content_hash,) in self._db.query(QueueEntry.content_hash).filter(
+            QueueEntry.crawl == self._crawl,
+            QueueEntry.depth_round == self._round,
+            QueueEntry.content_hash.in_(list(self._pending.keys()))
+        ))
+        entries = [self._entry(content_hash, content) for content_hash, content in self._pending.items()
+                   if content_hash not in existing]
+        self._pending = {}
+        try:
+            self._db.bulk_insert_mappings(QueueEntry, entries)
+            self._db.commit()
+        except IntegrityError:
+            # another node inserted some of these entries in the meantime
+            self._db.rollback()
+            for entry in entries:
+                try:
+                    self._db.bulk_insert_mappings(QueueEntry, [entry])
+                    self._db.commit()
+                except IntegrityError:
+                    self._db.rollback()
+
+    def _entry(self, content_hash, content):
+        return {
+            'crawl': self._crawl,
+            'depth_round': self._round,
+            'content': content,
+            'content_hash': content_hash,
+            'fld': Link.extract_fld(content.split(':', 2)[-1]),
+            'attempts': 0,
+            'retries': 0,
+            'done': False
+        }
+
+    def get(self):
+        if not hasattr(self._local, 'buffer'):
+            self._local.buffer = []
+        while True:
+            while len(self._local.buffer) > 0:
+                (uid, content, fld, token, retries) = self._local.buffer.pop(0)
+                if not self._renew(uid, token):
+                    # the lease ran out while this entry waited in the buffer, and another node took it over
+                    continue
+                not_before = self._reserve_host(fld)
+                if not_before is None:
+                    self._local.current = uid
+                    self._local.retries = retries
+                    return content
+                self._release(uid, token, not_before)
+            self._local.buffer = self._claim()
+            if len(self._local.buffer) == 0:
+                if self._closed.is_set() and self._count_undone() == 0:
+                    self._db.remove()
+                    return 'quit'
+                sleep(self._poll)
+
+    def task_done(self):
+        uid = getattr(self._local, 'current', None)
+        if uid is not None:
+            self._db.query(QueueEntry).filter(QueueEntry.uid == uid).update(
+                {QueueEntry.done: True, QueueEntry.lease_owner: None},
+                synchronize_session=False
+            )
+            self._db.commit()
+            self._local.current = None
+
+    def _available(self, now):
+        return self._db.query(QueueEntry.uid).filter(
+            QueueEntry.crawl == self._crawl,
+            QueueEntry.depth_round == self._round,
+            QueueEntry.done.is_(False),
+            or_(QueueEntry.lease_expires.is_(None), QueueEntry.lease_expires <= now)
+        ).order_by(QueueEntry.uid).limit(self._batch)
+
+    def _claim(self):
+        now = datetime.utcnow()
+        token = '%s/%s' % (self._node, uuid4().hex)
+        claimable = [QueueEntry.done.is_(False)]
+        if self._skip_locked:
+            try:
+                uids = [uid for (uid,) in self._available(now).with_for_update(skip_locked=True)]
+            except (OperationalError, ProgrammingError):
+                self._db.rollback()
+                log('SKIP LOCKED not supported', 'Falling back to atomic conditional claims')
+                self._skip_locked = False
+                return self._claim()
+        else:
+            uids = [uid for (uid,) in self._available(now)]
+            # without row locks, another node might have claimed these in between, so the lease is re-checked
+            claimable.append(or_(QueueEntry.lease_expires.is_(None), QueueEntry.lease_expires <= now))
+        if len(uids) > 0:
+            self._db.query(QueueEntry).filter(QueueEntry.uid.in_(uids), *claimable).update({
+                QueueEntry.lease_owner: token,
+                QueueEntry.lease_expires: now + self._lease,
+                QueueEntry.attempts: QueueEntry.attempts + 1
+            }, synchronize_session=False)
+        self._db.commit()
+        if len(uids) == 0:
+            return []
+        claimed = []
+        for uid, content, fld, attempts, retries in self._db.query(
+                QueueEntry.uid, QueueEntry.content, QueueEntry.fld, QueueEntry.attempts, QueueEntry.retries
+        ).filter(QueueEntry.lease_owner == token).order_by(QueueEntry.uid):
+            if attempts > self._max_attempts:
+                log('Queue entry given up after %d attempts' % (attempts - 1), content)
+                self._local.current = uid
+                self.task_done()
+            else:
+                claimed.append((uid, content, fld, token, retries))
+        return claimed
+
+    def defer(self, not_before):
+        """Puts the current entry back into the queue (claimable by any node from not_before on) as a retry.
+        Retries are counted separately (see retries) and limited through RetryScheduler, so the claim does not count
+        against Max_attempts.
+        """
+        uid = getattr(self._local, 'current', None)
+        if uid is not None:
+            self._db.query(QueueEntry).filter(QueueEntry.uid == uid).update({
+                QueueEntry.lease_owner: None,
+                QueueEntry.lease_expires: not_before,
+                QueueEntry.attempts: QueueEntry.attempts - 1,
+                QueueEntry.retries: QueueEntry.retries + 1
+            }, synchronize_session=False)
+            self._db.commit()
+            self._local.current = None
+
+    def retries(self):
+        """Returns the number of times the current entry has been deferred as a retry (by any node)."""
+        return getattr(self._local, 'retries', 0)
+
+    def release_buffer(self):
+        """Hands all entries claimed by the current thread but not yet started back to the queue."""
+        for (uid, content, fld, token, retries) in getattr(self._local, 'buffer', []):
+            self._release(uid, token, None)
+        self._local.buffer = []
+
+    def _renew(self, uid, token):
+        """Extends the lease of a claimed entry as it is taken from the buffer. Returns False if the lease is lost."""
+        renewed = self._db.query(QueueEntry).filter(QueueEntry.uid == uid, QueueEntry.lease_owner == token).update(
+            {QueueEntry.lease_expires: datetime.utcnow() + self._lease},
+            synchronize_session=False
+        )
+        self._db.commit()
+        return renewed > 0
+
+    def _release(self, uid, token, not_before):
+        self._db.query(QueueEntry).filter(QueueEntry.uid == uid, QueueEntry.lease_owner == token).update({
+            QueueEntry.lease_owner: None,
+            QueueEntry.lease_expires: not_before,
+            QueueEntry.attempts: QueueEntry.attempts - 1
+        }, synchronize_session=False)
+        self._db.commit()
+
+    def _reserve_host(self, fld):
+        """Returns None if the host was reserved for an immediate request, or else the time it becomes available."""
+        politeness = self._politeness
+        if host_cache is not None and fld != '':
+            # crawl delays requested through robots.txt apply across all nodes as well
+            politeness = max(politeness, timedelta(seconds=host_cache.crawl_delay('http://%s/' % fld)))
+        if fld == '' or politeness.total_seconds() <= 0:
+            return None
+        now = datetime.utcnow()
+        reserved = self._db.query(HostSlot).filter(HostSlot.fld == fld, HostSlot.next_request <= now).update(
+            {HostSlot.next_request: now + politeness},
+            synchronize_session=False
+        )
+        if reserved > 0:
+            self._db.commit()
+            return None
+        slot = self._db.query(HostSlot.next_request).filter(HostSlot.fld == fld).one_or_none()
+        if slot is not None:
+            self._db.commit()
+            return slot[0]
+        try:
+            self._db.add(HostSlot(fld=fld, next_request=now + politeness))
+            self._db.commit()
+            return None
+        except IntegrityError:
+            self._db.rollback()
+            return now + politeness
+
+    def _count_undone(self):
+        count = self._db.query(func.count(QueueEntry.uid)).filter(
+            QueueEntry.crawl == self._crawl,
+            QueueEntry.depth_round == self._round,
+            QueueEntry.done.is_(False)
+        ).one()[0]
+        self._db.commit()
+        return count
+
+
+def add_to_queue(queue, object_to_append, queued=None):
+    """Puts an Outlet, a Link, or a plain string into the queue. If a set of already queued lookup keys is given,
+    links whose canonical target URL is in there are skipped. Returns whether something was added.
+    (URLs disallowed by their host's robots.txt are skipped by the workers, see Scraper.process.)
+    """
     if isinstance(object_to_append, Outlet):
         queue.put('outlet:' + str(object_to_append.uid) + ':' + object_to_append.url)
-    elif isinstance(object_to_append, Link):
+    elif hasattr(object_to_append, 'url_target'):
+        # Link objects as well as link rows (see query_links)
+        if queued is not None:
+            url_target_hash = object_to_append.url_target_hash or Link.hash_url(object_to_append.url_target)
+            if url_target_hash in queued:
+                return False
+            queued.add(url_target_hash)
         queue.put('link:' + str(object_to_append.uid) + ':' + object_to_append.url_target)
     else:
         queue.put(object_to_append)
+    return True
+
 
+def query_links(*criteria):
+    """Returns a query for plain link rows (along with their target scrape's status code, if any) rather than Link
+    objects, which keeps them out of the session's identity map while traversing large parts of the link table.
+    """
+    scrape_target = aliased(Scrape)
+    return db.query(
+        Link.uid,
+        Link.url_target,
+        Link.url_target_hash,
+        Link.scrape_target_uid,
+        Link.erroneous_scrapes,
+        scrape_target.status_code.label('target_status_code')
+    ).outerjoin(scrape_target, scrape_target.uid == Link.scrape_target_uid).filter(*criteria)
 
-def recursively_add_links_to_queue(queue, current_level, links_from_current_level, max_depth):
+
+def recursively_add_links_to_queue(queue, current_level, links_from_current_level, max_depth, queued=None):
+    """Takes link rows (see query_links) of the current level, ideally as a chunked iterator (see iterate_in_chunks).
+    """
     links_actually_added_to_queue = 0
+    # links whose targets repeatedly failed (incl. the retries within each round) are not queued again
+    give_up_after = int(config.get('Retry', 'give_up_after', fallback=3))
     for link in links_from_current_level:
-        if link.scrape_target is None:
+        if link.erroneous_scrapes >= give_up_after and link.target_status_code != 200:
+            continue
+        if link.scrape_target_uid is None:
             # there is currently no target scrape set for this link
-            scrape_existent = db.query(Scrape).filter(
-                or_(Scrape.url_started == link.url_target, Scrape.url_finished == link.url_target),
+            url_target_hash = link.url_target_hash or Link.hash_url(link.url_target)
+            scrape_existent = db.query(Scrape.uid).filter(
+                or_(Scrape.url_started_hash == url_target_hash, Scrape.url_finished_hash == url_target_hash),
                 Scrape.status_code == 200
             ).order_by(Scrape.created).first()
             if scrape_existent is not None:
                 # target scrape found, updating link entry (no actual scraping takes place)
-                link = db.query(Link).filter(Link.uid == link.uid).one()
-                link.scrape_target_uid = scrape_existent.uid
+                db.query(Link).filter(Link.uid == link.uid).update(
+                    {Link.scrape_target_uid: scrape_existent.uid},
+                    synchronize_session=False
+                )
                 db.commit()
                 if current_level < max_depth:
                     links_actually_added_to_queue += recursively_add_links_to_queue(
                         queue,
                         current_level + 1,
-                        db.query(Link).filter(Link.scrape_origin_uid == link.scrape_target_uid).all(),
-                        max_depth
+                        iterate_in_chunks(query_links(Link.scrape_origin_uid == scrape_existent.uid), Link.uid),
+                        max_depth,
+                        queued
                     )
             else:
                 # due to multi-threading, we double-checked, but there is still no target scrape found
-                add_to_queue(queue, link)
-                links_actually_added_to_queue += 1
-        elif link.scrape_target.status_code != 200:
+                if add_to_queue(queue, link, queued):
+                    links_actually_added_to_queue += 1
+        elif link.target_status_code != 200:
             # target scrape already exists but was not successful (new scrape initiated)
-            add_to_queue(queue, link)
-            links_actually_added_to_queue += 1
+            if add_to_queue(queue, link, queued):
+                links_actually_added_to_queue += 1
         else:
             # target scrape found (no actual scraping takes place)
             if current_level < max_depth:
                 links_actually_added_to_queue += recursively_add_links_to_queue(
                     queue,
                     current_level + 1,
-                    db.query(Link).filter(Link.scrape_origin_uid == link.scrape_target_uid).all(),
-                    max_depth
+                    iterate_in_chunks(query_links(Link.scrape_origin_uid == link.scrape_target_uid), Link.uid),
+                    max_depth,
+                    queued
                 )
+        check_memory('Queueing links')
     return links_actually_added_to_queue
 
 
+def collect_statistics(db):
+    """Summarizes the current state of the database in two aggregate queries (one over Scrape, one over Link).
+    Returns a dictionary that can be formatted through format_statistics or stored through write_statistics.
+    """
+    scrape_status_200 = Scrape.status_code == 200
+    links_per_scrape = db.query(
+        Link.scrape_origin_uid.label('scrape_uid'),
+        func.count(Link.uid).label('n')
+    ).group_by(Link.scrape_origin_uid).subquery()
+    scrape_row = db.query(
+        func.count(Scrape.uid),
+        func.sum(case([(scrape_status_200, 1)], else_=0)),
+        func.count(case([(scrape_status_200, links_per_scrape.c.n)])),
+        func.sum(case([(scrape_status_200, links_per_scrape.c.n)], else_=0)),
+        func.sum(case([(scrape_status_200, links_per_scrape.c.n * links_per_scrape.c.n)], else_=0)),
+        func.sum(case([(scrape_status_200 & (links_per_scrape.c.n < 10), 1)], else_=0))
+    ).outerjoin(links_per_scrape, links_per_scrape.c.scrape_uid == Scrape.uid).one()
+
+    link_external = Link.is_internal.is_(False)
+    links_per_host = db.query(
+        func.count(Link.uid).label('n'),
+        func.sum(case([(Link.is_internal, 1)], else_=0)).label('n_internal'),
+        func.sum(case([(link_external, 1)], else_=0)).label('n_external'),
+        func.sum(case([(link_external & Link.scrape_target_uid.in_(
+            db.query(Outlet.scrape_uid).filter(Outlet.scrape_uid.isnot(None))
+        ), 1)], else_=0)).label('n_outlet_direct'),
+        func.sum(case([(link_external & Link.host_target_uid.in_(
+            db.query(Outlet.host_uid).filter(Outlet.host_uid.isnot(None))
+        ), 1)], else_=0)).label('n_outlet_host')
+    ).group_by(Link.host_origin_uid).subquery()
+    link_row = db.query(
+        func.count(),
+        func.min(links_per_host.c.n),
+        func.max(links_per_host.c.n),
+        func.sum(links_per_host.c.n_internal),
+        func.sum(links_per_host.c.n_external),
+        func.sum(links_per_host.c.n_outlet_direct),
+        func.sum(links_per_host.c.n_outlet_host)
+    ).select_from(links_per_host).one()
+
+    # MySQL returns SUM() as Decimal and None for empty tables, so everything gets normalized to int
+    (scrape_total, scrape_successful, scrape_with_links, links_sum, links_sum_of_squares, scrape_below_10) = \
+        (int(value or 0) for value in scrape_row)
+    (hosts, host_min_documents, host_max_documents,
+     links_internal, links_external, links_outlet_direct, links_outlet_host) = (int(value or 0) for value in link_row)
+
+    statistics = {
+        'scrapes': {
+            'total': scrape_total,
+            'successful': scrape_successful
+        },
+        'hosts': {
+            'total': hosts,
+            'min_documents': host_min_documents,
+            'max_documents': host_max_documents
+        },
+        'links': {
+            'total': links_internal + links_external,
+            'internal': links_internal,
+            'external': links_external,
+            'outlet_direct': links_outlet_direct,
+            'outlet_host': links_outlet_host
+        },
+        'links_per_scrape': None
+    }
+    if scrape_with_links > 1:
+        links_mean = links_sum / scrape_with_links
+        links_variance = (links_sum_of_squares - scrape_with_links * links_mean * links_mean) / (scrape_with_links - 1)
+        statistics['links_per_scrape'] = {
+            'scrapes': scrape_with_links,
+            'mean': links_mean,
+            'sd': sqrt(max(links_variance, 0)),
+            'below_10': scrape_below_10
+        }
+    return statistics
+
+
+def format_statistics(statistics):
+    scrapes = statistics['scrapes']
+    text = '%d websites scraped, %d of which (%d%%) were successful (i.e., status code 200)' % (
+        scrapes['total'],
+        scrapes['successful'],
+        (0 if scrapes['total'] == 0 else 100 * scrapes['successful'] / scrapes['total'])
+    )
+    hosts = statistics['hosts']
+    if hosts['total'] == 0:
+        text += '\n' + 'no hosts scraped'
+    else:
+        text += '\n' + (
+                '%d hosts scraped, containing between %d and %d documents' %
+                (hosts['total'], hosts['min_documents'], hosts['max_documents'])
+        )
+    links = statistics['links']
+    text += '\n' + (
+            '%d links collected, %d of which are external (%d%%)' %
+            (links['total'], links['external'], (0 if links['total'] == 0 else 100 * links['external'] / links['total']))
+    )
+    text += '\n' + (
+            '%d external links (%d%% out of %d external links) link directly to pre-configured outlet pages' % (
+                links['outlet_direct'],
+                (0 if links['external'] == 0 else (100 * links['outlet_direct'] / links['external'])),
+                links['external']
+            )
+    )
+    text += '\n' + (
+            '%d external links (%d%% out of %d external links) link to outlet hosts' % (
+                links['outlet_host'],
+                (0 if links['external'] == 0 else (100 * links['outlet_host'] / links['external'])),
+                links['external']
+            )
+    )
+    links_per_scrape = statistics['links_per_scrape']
+    if links_per_scrape is not None:
+        text += '\n' + (
+                'on average, scrapes resulted in M = %.1f links (SD = %.1f)' %
+                (links_per_scrape['mean'], links_per_scrape['sd'])
+        )
+        text += '\n' + ('%d status-200 scrapes have less than 10 links' % links_per_scrape['below_10'])
+    return text
+
+
+def write_statistics(statistics, file):
+    with open(file, 'w') as f:
+        json.dump(statistics, f, indent=2)
+
+
+def check_memory(context):
+    """Compares the process's memory usage with [Scraper] Memory_limit (in MB). Above the limit, garbage is
+    collected (at most once a minute) and, if that does not help, a notification is sent (at most once per process).
+    """
+    global memory_warning_sent, memory_collected
+    limit = float(config.get('Scraper', 'memory_limit', fallback=0))
+    if limit <= 0 or get_memory_usage() <= limit:
+        return True
+    if time() - memory_collected < 60:
+        # a full collection per call would bring a process that stays above the limit to a crawl
+        return False
+    memory_collected = time()
+    gc.collect()
+    usage = get_memory_usage()
+    if usage <= limit:
+        return True
+    if not memory_warning_sent:
+        memory_warning_sent = True
+        log('Memory watermark exceeded', '%s: %.0f MB in use (limit is %.0f MB)' % (context, usage, limit), True)
+    return False
+
+
 def log(gist, msg, very_important_msg=False):
     print(('%s: %s' % (gist, msg)) if len(msg) < 80 else gist)
     if very_important_msg:
-        send_email(config,
-                   '[GeoNewsNet] %s' % gist,
-                   'Hi there!\n\n%s\n\n%s\n' % (gist, msg),
-                   do_not_die=True)
+        notifier.notify('[GeoNewsNet] %s' % gist, msg)
 
 
 if __name__ == '__main__':
@@ -171,19 +1073,43 @@ if __name__ == '__main__':
     log('(c) 2019', 'Mario Haim <mario@haim.it>')
 
     config = get_config()
+    Link.configure_canonicalization(config)
+    notifier = Notifier(config)
+    notifier.start()
     db_engine = get_engine(config)
     db = get_database(db_engine)
-    queue = Queue()
+    hosts = HostRegistry(db_engine)
+    host_cache = HostMetadataCache(config)
+    host_cache.load()
+    host_cache.install_resolver()
+    distributed = config.get('Queue', 'distributed', fallback='0') == '1'
+    queue = DatabaseQueue(config, db_engine) if distributed else Queue()
     threads = []
+    retries = RetryScheduler(config, queue)
+    retries.start()
 
     workers = int(config.get('Scraper', 'threads', fallback=4))
     max_depth = int(config.get('Scraper', 'depth', fallback=1))
+    controller = None
+    if config.get('Scraper', 'adaptive', fallback='0') == '1':
+        controller = ConcurrencyController(
+            config,
+            workers,
+            int(config.get('Scraper', 'min_threads', fallback=1)),
+            int(config.get('Scraper', 'max_threads', fallback=workers * 4))
+        )
+        # all workers are started, but only as many as the controller allows fetch at the same time
+        workers = controller.maximum
 
     for i in range(max_depth + 1):
         log('%d of %d' % (i + 1, max_depth + 1), 'Round of scraping started with %d parallel scrapers' % workers)
+        if distributed:
+            queue.start_round(i)
+        retries.reset()
 
+        threads = []
         for j in range(workers):
-            worker = Scraper(queue, config, db_engine)
+            worker = Scraper(queue, config, db_engine, hosts, controller, retries)
             worker.start()
             threads.append(worker)
 
@@ -197,12 +1123,11 @@ if __name__ == '__main__':
 
         # for all Outlet-related Scrape objects (level=1), start the recursive process for all Link objects (level=2)
         if max_depth > 1:
-            links = db.query(Link).filter(
-                Link.scrape_origin_uid == Scrape.uid,
-                Scrape.uid == Outlet.scrape_uid,
-                Outlet.scrape_uid.isnot(None)
-            ).all()
-            links_actually_added_to_queue = recursively_add_links_to_queue(queue, 2, links, max_depth)
+            links = iterate_in_chunks(query_links(
+                Link.scrape_origin_uid.in_(db.query(Outlet.scrape_uid).filter(Outlet.scrape_uid.isnot(None)))
+            ), Link.uid)
+            # every canonical URL is queued only once per round
+            links_actually_added_to_queue = recursively_add_links_to_queue(queue, 2, links, max_depth, set())
             if links_actually_added_to_queue > 0:
                 log(
                     '%d not-yet-visited links added to scraper' % links_actually_added_to_queue,
@@ -210,73 +1135,32 @@ if __name__ == '__main__':
                     True
                 )
 
-        for worker in threads:
-            add_to_queue(queue, 'quit')
+        if distributed:
+            queue.close_round()
+        else:
+            # wait for all scrapes, including retries that only become due later on
+            while True:
+                queue.join()
+                # a retry may have become due (and been put into the queue) right after join() returned
+                if not retries.wait_for_pending() and queue.unfinished_tasks == 0:
+                    break
+            for worker in threads:
+                add_to_queue(queue, 'quit')
         for worker in threads:
             worker.join()
 
         db.commit()
         db.close()
         db = get_database(db_engine)
+        host_cache.save()
 
-    scrape_total = db.query(func.count(Scrape.uid)).one()[0]
-    scrape_successful = db.query(func.count(Scrape.uid)).filter(Scrape.status_code == 200).one()[0]
-    statistics = '%d websites scraped, %d of which (%d%%) were successful (i.e., status code 200)' % \
-                 (scrape_total, scrape_successful, (0 if scrape_total == 0 else 100*scrape_successful/scrape_total))
-    scrape_host_result = db.query(func.count(Link.uid)).group_by(Link.fld_origin)
-    if scrape_host_result.count() == 0:
-        statistics += '\n' + 'no hosts scraped'
-    else:
-        scrape_min_documents = min(count[0] for count in scrape_host_result.all())
-        scrape_max_documents = max(count[0] for count in scrape_host_result.all())
-        statistics += '\n' + (
-                '%d hosts scraped, containing between %d and %d documents' %
-                (scrape_host_result.count(), scrape_min_documents, scrape_max_documents)
-        )
-    try:
-        links_internal = db.query(func.count(Link.uid)).filter(Link.is_internal).one()[0]
-        links_external = db.query(func.count(Link.uid)).filter(Link.is_internal.is_(False)).one()[0]
-    except:
-        links_internal = 0
-        links_external = 0
-    links_total = links_internal + links_external
-    statistics += '\n' + (
-            '%d links collected, %d of which are external (%d%%)' %
-            (links_total, links_external, (0 if links_total == 0 else 100 * links_external / links_total))
-    )
-    links_outlet_direct = db.query(Link.uid, Outlet.uid).filter(
-        Link.scrape_target_uid == Outlet.scrape_uid,
-        Link.is_internal.is_(False)
-    ).group_by(Link.uid).count()
-    statistics += '\n' + (
-            '%d external links (%d%% out of %d external links) link directly to pre-configured outlet pages' % (
-                links_outlet_direct,
-                (0 if links_external == 0 else (100 * links_outlet_direct / links_external)),
-                links_external
-            )
-    )
-    links_outlet_host = db.query(Link.uid, Outlet.uid).filter(
-        Link.fld_target == Outlet.fld,
-        Link.is_internal.is_(False)
-    ).group_by(Link.uid).count()
-    statistics += '\n' + (
-            '%d external links (%d%% out of %d external links) link to outlet hosts' % (
-                links_outlet_host,
-                (0 if links_external == 0 else (100 * links_outlet_host / links_external)),
-                links_external
-            )
-    )
-    scrape_link_result = db.query(func.count(Link.uid))\
-        .filter(Link.scrape_origin_uid == Scrape.uid, Scrape.status_code == 200)\
-        .group_by(Link.scrape_origin_uid)
-    if scrape_link_result.count() > 1:
-        mean_number_of_links = mean(count[0] for count in scrape_link_result.all())
-        sd_number_of_links = stdev(count[0] for count in scrape_link_result.all())
-        statistics += '\n' + (
-                'on average, scrapes resulted in M = %.1f links (SD = %.1f)' %
-                (mean_number_of_links, sd_number_of_links)
-        )
-        below_10_number_of_links = sum((1 if count[0] < 10 else 0) for count in scrape_link_result.all())
-        statistics += '\n' + ('%d status-200 scrapes have less than 10 links' % below_10_number_of_links)
+    if controller is not None:
+        log('Adaptive concurrency', 'Converged at %d parallel fetches' % controller.limit)
+    statistics = collect_statistics(db)
+    statistics_file = config.get('Scraper', 'statistics', fallback='')
+    if statistics_file != '':
+        write_statistics(statistics, statistics_file)
+        log('Statistics report written', statistics_file)
 
-    log('Scrape done in %.2f seconds' % (time() - t0), statistics + '\n', True)
+    log('Scrape done in %.2f seconds' % (time() - t0), format_statistics(statistics) + '\n', True)
+    notifier.close()
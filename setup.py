@@ -1,12 +1,17 @@
 from time import time
+from datetime import datetime
+import os
+import threading
+from queue import Queue, Empty, Full
+from collections import deque
 import requests
 import configparser
 import sys
 import traceback
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text, or_
 from sqlalchemy.orm import sessionmaker, scoped_session
 import csv
-from database import base, Outlet, Scrape, Link, Sector
+from database import base, Outlet, Scrape, Link, Sector, Host, HostRegistry
 from tld.utils import update_tld_names
 import smtplib
 import ssl
@@ -70,111 +75,323 @@ def get_database(engine, do_not_die=False):
             die_with_error('Database session could not be initiated')
 
 
+def read_csv_source(source):
+    """Reads CSV lines either from a local file or from a (Google Sheet) URL."""
+    if os.path.isfile(source):
+        print('- reading local file %s' % source)
+        with open(source, encoding='utf8') as file:
+            return file.read().splitlines()
+    print('- retrieving from Google Drive %s' % source)
+    response = requests.get(source)
+    if response.status_code == 200:
+        return response.content.decode('utf8').splitlines()
+    else:
+        die_with_error('Google Drive returned unexpected status code %d' % response.status_code)
+
+
+def sort_sectors_topologically(parents):
+    """Takes a dictionary of sector names mapped to their parent names ('' for root sectors).
+    Returns all sector names ordered such that parents precede their children.
+    Sectors caught in cyclic parent relations are appended at the end (and attached to root level by the caller).
+    """
+    children = {}
+    pending = {}
+    for name, parent in parents.items():
+        if parent != '' and parent in parents and parent != name:
+            children.setdefault(parent, []).append(name)
+            pending[name] = 1
+        else:
+            pending[name] = 0
+    ordered = [name for name, count in pending.items() if count == 0]
+    i = 0
+    while i < len(ordered):
+        for child in children.get(ordered[i], []):
+            pending[child] -= 1
+            if pending[child] == 0:
+                ordered.append(child)
+        i = i + 1
+    cyclic = [name for name, count in pending.items() if count > 0]
+    return ordered, cyclic
+
+
+def iterate_in_chunks(query, key, chunk_size=10000):
+    """Yields the rows of query in chunks, paginated by the (unique) key column rather than by OFFSET. Neither is the
+    whole result held in memory nor does a cursor stay open in between, so the session remains usable meanwhile.
+    """
+    last = None
+    while True:
+        chunk = query if last is None else query.filter(key > last)
+        rows = chunk.order_by(key).limit(chunk_size).all()
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last = getattr(rows[-1], key.key)
+
+
+def stream_query(query, chunk_size=10000):
+    """Streams the rows of query through a server-side cursor. As the cursor blocks the session's connection until
+    all rows are read, no other queries may be run through the same session while iterating.
+    """
+    return query.execution_options(stream_results=True).yield_per(chunk_size)
+
+
+def get_memory_usage():
+    """Returns the process's current resident memory in MB (or its peak, where the current value is unavailable)."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
 def import_sectors(config, db):
     sheet = config.get('Google', 'sectors')
-    if sheet is not '':
-        print('- retrieving sectors from Google Drive %s' % sheet)
+    if sheet != '':
         try:
-            response = requests.get(sheet)
-            if response.status_code == 200:
-                csv_raw = response.content.decode('utf8')
-                csv_list = csv_raw.splitlines()
-                csv_data = csv.DictReader(csv_list,
-                                          fieldnames=['parent', 'name'],
-                                          dialect=csv.Sniffer().sniff(csv_list[0]))
-                if config.get('Google', 'sectors_have_headers') == '1':
-                    next(csv_data, None)
-                    print('- skipping header row')
-                counter_new = 0
-                counter_update = 0
-                for entry in csv_data:
-                    sector_name = entry['name'].strip()
-                    temp_sector = db.query(Sector).filter(Sector.name == sector_name).one_or_none()
-                    temp_parent = None
-                    if entry['parent'] != '':
-                        temp_parent = db.query(Sector).filter(Sector.name == entry['parent'].strip()).one_or_none()
-                        if temp_parent is None:
-                            print('- parent "%s" not found, sector attached to root level' % entry['parent'])
-                    if temp_sector is None:
-                        temp_sector = Sector(name=sector_name)
-                        if temp_parent is not None:
-                            temp_sector.parent_uid = temp_parent.uid
-                        db.add(temp_sector)
-                        counter_new = counter_new + 1
-                    else:
-                        if temp_parent is None and temp_sector.parent_uid is not None:
-                            temp_sector.parent_uid = None
-                            counter_update = counter_update + 1
-                        elif temp_parent is not None and temp_parent.uid is not temp_sector.parent_uid:
-                            temp_sector.parent_uid = temp_parent.uid
-                            counter_update = counter_update + 1
-                    db.commit()
-                print('- imported %d new sectors' % counter_new)
-                print('- updated %d sectors' % counter_update)
-            else:
-                die_with_error('Google Drive returned unexpected status code %d' % response.status_code)
+            csv_list = read_csv_source(sheet)
+            csv_data = csv.DictReader(csv_list,
+                                      fieldnames=['parent', 'name'],
+                                      dialect=csv.Sniffer().sniff(csv_list[0]))
+            if config.get('Google', 'sectors_have_headers') == '1':
+                next(csv_data, None)
+                print('- skipping header row')
+            parents = {}
+            for entry in csv_data:
+                parents[entry['name'].strip()] = entry['parent'].strip()
+            ordered, cyclic = sort_sectors_topologically(parents)
+            for name in cyclic:
+                print('- parent "%s" of "%s" forms a cycle, sector attached to root level' % (parents[name], name))
+                parents[name] = ''
+
+            existing = {name: (uid, parent_uid) for uid, name, parent_uid in
+                        db.query(Sector.uid, Sector.name, Sector.parent_uid)}
+            new_sectors = [{'name': name} for name in ordered + cyclic if name not in existing]
+            if len(new_sectors) > 0:
+                db.bulk_insert_mappings(Sector, new_sectors)
+            uids = {name: uid for uid, name in db.query(Sector.uid, Sector.name)}
+
+            updates = []
+            counter_update = 0
+            for name in ordered + cyclic:
+                parent_uid = None
+                if parents[name] != '':
+                    parent_uid = uids.get(parents[name])
+                    if parent_uid is None:
+                        print('- parent "%s" not found, sector attached to root level' % parents[name])
+                if name in existing:
+                    if existing[name][1] != parent_uid:
+                        updates.append({'uid': uids[name], 'parent_uid': parent_uid})
+                        counter_update = counter_update + 1
+                elif parent_uid is not None:
+                    updates.append({'uid': uids[name], 'parent_uid': parent_uid})
+            if len(updates) > 0:
+                db.bulk_update_mappings(Sector, updates)
+            db.commit()
+            print('- imported %d new sectors' % len(new_sectors))
+            print('- updated %d sectors' % counter_update)
         except:
-            die_with_error('Google Drive could not be contacted properly')
+            db.rollback()
+            die_with_error('Sectors could not be imported properly')
 
 
 def import_outlets(config, db):
     sheet = config.get('Google', 'outlets')
-    if sheet is not '':
-        print('- retrieving outlets from Google Drive %s' % sheet)
+    if sheet != '':
         try:
-            response = requests.get(sheet)
-            if response.status_code == 200:
-                csv_raw = response.content.decode('utf8')
-                csv_list = csv_raw.splitlines()
-                csv_data = csv.DictReader(csv_list,
-                                          fieldnames=['url', 'name', 'area',
-                                                      'level', 'sector', 'subsector', 'owner',
-                                                      'reach', 'reach_unit', 'founding_year', 'revenue', 'topic',
-                                                      'notes',
-                                                      'latitude', 'longitude'],
-                                          dialect=csv.Sniffer().sniff(csv_list[0]))
-                if config.get('Google', 'outlets_have_headers') == '1':
-                    next(csv_data, None)
-                    print('- skipping header row')
-                counter_new = 0
-                counter_update = 0
-                for entry in csv_data:
-                    outlet_url = Link.sanitize_url(entry['url'].strip(), base_url='')
-                    if outlet_url == '':
-                        print('- urgs, URL "%s" could not be parsed correctly and was skipped' % entry['url'])
-                        continue
-                    temp_outlet = db.query(Outlet).filter(Outlet.url == outlet_url).one_or_none()
-                    temp_sector = None
-                    if entry['subsector'] != '':
-                        temp_sector = db.query(Sector).filter(Sector.name == entry['subsector']).one_or_none()
-                    if temp_outlet is None:
-                        temp_outlet = Outlet(url=outlet_url)
-                        db.add(temp_outlet)
-                        counter_new = counter_new + 1
-                    else:
-                        counter_update = counter_update + 1
-                    temp_outlet.name = entry['name'].strip()
-                    temp_outlet.area = Outlet.sanitize_area(entry['area'])
-                    if temp_sector is not None:
-                        temp_outlet.sector_uid = temp_sector.uid
-                    temp_outlet.ownership = entry['owner'].strip()
-                    temp_outlet.level = Outlet.sanitize_level(entry['level'])
-                    temp_outlet.reach = int(float(entry['reach'])) if entry['reach'] != '' else None
-                    temp_outlet.reach_unit = entry['reach_unit'].strip() if entry['reach_unit'] != '' else None
-                    temp_outlet.founding_year = int(entry['founding_year']) if entry['founding_year'] != '' else None
-                    temp_outlet.revenue = entry['revenue'].strip() if entry['revenue'] != '' else None
-                    temp_outlet.topic = entry['topic'].strip() if entry['topic'] != '' else None
-                    temp_outlet.note = entry['notes'].strip() if entry['notes'] != '' else None
-                    temp_outlet.latitude = float(entry['latitude']) if entry['latitude'] != '' else None
-                    temp_outlet.longitude = float(entry['longitude']) if entry['longitude'] != '' else None
-                    temp_outlet.fld = Link.extract_fld(outlet_url)
-                db.commit()
-                print('- imported %d new outlets' % counter_new)
-                print('- updated %d outlets' % counter_update)
-            else:
-                die_with_error('Google Drive returned unexpected status code %d' % response.status_code)
+            csv_list = read_csv_source(sheet)
+            csv_data = csv.DictReader(csv_list,
+                                      fieldnames=['url', 'name', 'area',
+                                                  'level', 'sector', 'subsector', 'owner',
+                                                  'reach', 'reach_unit', 'founding_year', 'revenue', 'topic',
+                                                  'notes',
+                                                  'latitude', 'longitude'],
+                                      dialect=csv.Sniffer().sniff(csv_list[0]))
+            if config.get('Google', 'outlets_have_headers') == '1':
+                next(csv_data, None)
+                print('- skipping header row')
+            hosts = HostRegistry(db.get_bind())
+            existing = {url: uid for uid, url in db.query(Outlet.uid, Outlet.url)}
+            sectors = {name: uid for uid, name in db.query(Sector.uid, Sector.name)}
+            outlets = {}
+            for entry in csv_data:
+                outlet_url = Link.sanitize_url(entry['url'].strip(), base_url='')
+                if outlet_url == '':
+                    print('- urgs, URL "%s" could not be parsed correctly and was skipped' % entry['url'])
+                    continue
+                outlet = {
+                    'url': outlet_url,
+                    'name': entry['name'].strip(),
+                    'area': Outlet.sanitize_area(entry['area']),
+                    'ownership': entry['owner'].strip(),
+                    'level': Outlet.sanitize_level(entry['level']),
+                    'reach': int(float(entry['reach'])) if entry['reach'] != '' else None,
+                    'reach_unit': entry['reach_unit'].strip() if entry['reach_unit'] != '' else None,
+                    'founding_year': int(entry['founding_year']) if entry['founding_year'] != '' else None,
+                    'revenue': entry['revenue'].strip() if entry['revenue'] != '' else None,
+                    'topic': entry['topic'].strip() if entry['topic'] != '' else None,
+                    'note': entry['notes'].strip() if entry['notes'] != '' else None,
+                    'latitude': float(entry['latitude']) if entry['latitude'] != '' else None,
+                    'longitude': float(entry['longitude']) if entry['longitude'] != '' else None,
+                    'fld': Link.extract_fld(outlet_url)
+                }
+                outlet['host_uid'] = hosts.get_uid(outlet['fld'])
+                if entry['subsector'] != '' and entry['subsector'] in sectors:
+                    outlet['sector_uid'] = sectors[entry['subsector']]
+                if outlet_url in existing:
+                    outlet['uid'] = existing[outlet_url]
+                # later rows for the same URL overwrite earlier ones, just as consecutive updates would
+                outlets[outlet_url] = outlet
+            new_outlets = [outlet for outlet in outlets.values() if 'uid' not in outlet]
+            updated_outlets = [outlet for outlet in outlets.values() if 'uid' in outlet]
+            if len(new_outlets) > 0:
+                db.bulk_insert_mappings(Outlet, new_outlets)
+            if len(updated_outlets) > 0:
+                db.bulk_update_mappings(Outlet, updated_outlets)
+            db.commit()
+            print('- imported %d new outlets' % len(new_outlets))
+            print('- updated %d outlets' % len(updated_outlets))
         except:
-            die_with_error('Google Drive could not be contacted properly')
+            db.rollback()
+            die_with_error('Outlets could not be imported properly')
+
+
+def migrate_hosts(engine, db, chunk_size=10000):
+    """Converts databases from before the host table was introduced: every first-level domain is stored once in
+    host and referenced by integer keys from link, scrape, and outlet. Afterwards, the redundant string columns
+    (link.url_origin, which equals the origin scrape's url_finished, as well as link.fld_origin/fld_target) are
+    dropped. Every step skips what is already done, so an interrupted migration is resumed by running it again.
+    """
+    print('- migrating first-level domains into host table')
+    inspector = inspect(engine)
+    columns = dict((table, [column['name'] for column in inspector.get_columns(table)])
+                   for table in ['link', 'scrape', 'outlet'])
+    with engine.begin() as connection:
+        for table, column in [('link', 'host_origin_uid'), ('link', 'host_target_uid'), ('scrape', 'host_uid'),
+                              ('outlet', 'host_uid')]:
+            if column not in columns[table]:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s INTEGER NULL' % (table, column)))
+    old_columns = [column for column in ['url_origin', 'fld_origin', 'fld_target'] if column in columns['link']]
+
+    if 'fld_origin' in old_columns and 'fld_target' in old_columns:
+        flds = set()
+        for statement in ['SELECT DISTINCT fld_origin FROM link', 'SELECT DISTINCT fld_target FROM link',
+                          'SELECT DISTINCT fld FROM outlet']:
+            flds.update(fld for (fld,) in db.execute(text(statement)))
+        known = set(fld for (fld,) in db.query(Host.fld))
+        hosts = [Host.describe(fld) for fld in flds if fld not in known]
+        for i in range(0, len(hosts), chunk_size):
+            db.bulk_insert_mappings(Host, hosts[i:i + chunk_size])
+            db.commit()
+        print('- %d hosts stored' % len(hosts))
+
+        with engine.begin() as connection:
+            print('- referencing hosts from outlets')
+            connection.execute(text(
+                'UPDATE outlet SET host_uid = (SELECT host.uid FROM host WHERE host.fld = outlet.fld) ' +
+                'WHERE host_uid IS NULL'
+            ))
+
+        print('- referencing hosts from links (this may take a while)')
+        (min_uid, max_uid) = db.execute(text('SELECT MIN(uid), MAX(uid) FROM link')).fetchone()
+        db.commit()
+        if min_uid is not None:
+            # in uid ranges, each within its own transaction, as a single update would take ages on large tables
+            for lower_uid in range(min_uid, max_uid + 1, chunk_size):
+                with engine.begin() as connection:
+                    connection.execute(text(
+                        'UPDATE link SET ' +
+                        'host_origin_uid = (SELECT host.uid FROM host WHERE host.fld = link.fld_origin), ' +
+                        'host_target_uid = (SELECT host.uid FROM host WHERE host.fld = link.fld_target) ' +
+                        'WHERE uid >= :lower_uid AND uid < :upper_uid AND host_origin_uid IS NULL'
+                    ), lower_uid=lower_uid, upper_uid=lower_uid + chunk_size)
+
+    print('- referencing hosts from scrapes')
+    registry = HostRegistry(engine)
+    last_uid = 0
+    while True:
+        scrapes = db.query(Scrape.uid, Scrape.url_finished).filter(Scrape.uid > last_uid, Scrape.host_uid.is_(None))\
+            .order_by(Scrape.uid).limit(chunk_size).all()
+        if len(scrapes) == 0:
+            break
+        db.bulk_update_mappings(Scrape, [
+            {'uid': uid, 'host_uid': registry.get_uid(Link.extract_fld(url))} for uid, url in scrapes if url
+        ])
+        db.commit()
+        last_uid = scrapes[-1][0]
+
+    print('- indexing host references and dropping redundant columns')
+    indexes = set(index['name'] for table in ['link', 'scrape', 'outlet'] for index in inspector.get_indexes(table))
+    with engine.begin() as connection:
+        for index, table, column in [('ix_link_host_origin_uid', 'link', 'host_origin_uid'),
+                                     ('ix_link_host_target_uid', 'link', 'host_target_uid'),
+                                     ('ix_scrape_host_uid', 'scrape', 'host_uid'),
+                                     ('ix_outlet_host_uid', 'outlet', 'host_uid')]:
+            if index not in indexes:
+                connection.execute(text('CREATE INDEX %s ON %s (%s)' % (index, table, column)))
+    # the old columns go last, as their presence is what marks the migration as unfinished (see __main__)
+    with engine.begin() as connection:
+        for column in old_columns:
+            connection.execute(text('ALTER TABLE link DROP COLUMN %s' % column))
+
+
+url_hash_columns = [('scrape', 'url_started'), ('scrape', 'url_finished'), ('link', 'url_target')]
+
+
+def url_hashes_incomplete(engine):
+    """Returns whether any URL hash column (see migrate_url_hashes) is missing or any hash is yet to be filled."""
+    inspector = inspect(engine)
+    with engine.connect() as connection:
+        for table, column in url_hash_columns:
+            if column + '_hash' not in [existing['name'] for existing in inspector.get_columns(table)]:
+                return True
+            if connection.execute(text(
+                'SELECT uid FROM %s WHERE %s_hash IS NULL AND %s IS NOT NULL LIMIT 1' % (table, column, column)
+            )).first() is not None:
+                return True
+    return False
+
+
+def migrate_url_hashes(engine, db, chunk_size=10000):
+    """Adds the indexed lookup keys (hashes of canonical URLs) to scrapes and links of databases from before they
+    were introduced and fills them in chunks. Only missing columns and indexes are added and only missing hashes
+    are filled, so an interrupted migration is resumed by running it again.
+    """
+    print('- adding canonical URL hashes to scrapes and links')
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, column in url_hash_columns:
+            if column + '_hash' not in [existing['name'] for existing in inspector.get_columns(table)]:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s_hash VARCHAR(40) NULL' % (table, column)))
+    for model, columns in [(Scrape, ['url_started', 'url_finished']), (Link, ['url_target'])]:
+        missing = or_(*[getattr(model, column + '_hash').is_(None) & getattr(model, column).isnot(None)
+                        for column in columns])
+        last_uid = 0
+        counter = 0
+        while True:
+            rows = db.query(model.uid, *[getattr(model, column) for column in columns])\
+                .filter(model.uid > last_uid, missing).order_by(model.uid).limit(chunk_size).all()
+            if len(rows) == 0:
+                break
+            db.bulk_update_mappings(model, [
+                dict([('uid', row[0])] + [
+                    (column + '_hash', Link.hash_url(url) if url is not None else None)
+                    for column, url in zip(columns, row[1:])
+                ]) for row in rows
+            ])
+            db.commit()
+            last_uid = rows[-1][0]
+            counter += len(rows)
+        print('- %d %s entries updated' % (counter, model.__tablename__))
+    indexes = set(index['name'] for table in ['scrape', 'link'] for index in inspector.get_indexes(table))
+    with engine.begin() as connection:
+        for table, column in url_hash_columns:
+            index = 'ix_%s_%s_hash' % (table, column)
+            if index not in indexes:
+                connection.execute(text('CREATE INDEX %s ON %s (%s_hash)' % (index, table, column)))
 
 
 def get_browser_header(config):
@@ -198,7 +415,8 @@ def get_mailer(config, do_not_die=False):
         else:
             print('- connecting to %s via port %d' % (host, port))
             server = smtplib.SMTP_SSL(host, port, context=context)
-        server.login(config.get('Email', 'user'), config.get('Email', 'password'))
+        if config.get('Email', 'user', fallback='') != '':
+            server.login(config.get('Email', 'user'), config.get('Email', 'password'))
     except:
         if do_not_die:
             present_error('connection to SMTP server failed')
@@ -208,13 +426,10 @@ def get_mailer(config, do_not_die=False):
     return server
 
 
-def send_email(config, subject, message, attachments=None, do_not_die=False):
-    sender = config.get('Email', 'sender')
-    recipient = config.get('Email', 'recipient')
-    print('- attempting to send an email ("%s") to %s' % (subject, recipient))
+def compose_email(config, subject, message, attachments=None):
     msg = MIMEMultipart()
-    msg['From'] = sender
-    msg['To'] = recipient
+    msg['From'] = config.get('Email', 'sender')
+    msg['To'] = config.get('Email', 'recipient')
     msg['Subject'] = subject
     msg.attach(MIMEText(message, 'plain'))
     if attachments is not None:
@@ -229,6 +444,14 @@ def send_email(config, subject, message, attachments=None, do_not_die=False):
                     print('- attaching "%s" to the email' % attachment)
             except:
                 print('- "%s" could not be attached to email' % attachment)
+    return msg
+
+
+def send_email(config, subject, message, attachments=None, do_not_die=False):
+    sender = config.get('Email', 'sender')
+    recipient = config.get('Email', 'recipient')
+    print('- attempting to send an email ("%s") to %s' % (subject, recipient))
+    msg = compose_email(config, subject, message, attachments)
     try:
         mailer = get_mailer(config)
         if mailer is not None:
@@ -240,6 +463,132 @@ def send_email(config, subject, message, attachments=None, do_not_die=False):
             die_with_error('email could not be sent')
 
 
+class Notifier(threading.Thread):
+    """Sends notification emails from a background thread, so that callers never block on SMTP.
+    Notifications arriving within the digest window are combined into one email, a single SMTP connection is
+    reused across emails, and no more than max_per_hour emails are sent (surplus notifications wait for the next
+    digest). At most max_pending notifications wait at a time; further ones are dropped and only counted.
+    Pass mailer_factory to send through something other than get_mailer (e.g., a local SMTP stand-in).
+    """
+    _quit = object()
+
+    def __init__(self, config, window=None, max_per_hour=None, max_pending=1000, mailer_factory=None):
+        threading.Thread.__init__(self, daemon=True)
+        self._config = config
+        self._window = float(config.get('Email', 'digest', fallback=60) if window is None else window)
+        self._max_per_hour = int(config.get('Email', 'max_per_hour', fallback=30)
+                                 if max_per_hour is None else max_per_hour)
+        self._max_pending = max_pending
+        self._queue = Queue(maxsize=max_pending)
+        self._mailer_factory = mailer_factory if mailer_factory is not None \
+            else (lambda: get_mailer(self._config, do_not_die=True))
+        self._mailer = None
+        self._sent = deque()
+        self._closing = threading.Event()
+        # changed from callers' threads (notify) as well as from the dispatcher thread
+        self._dropped_lock = threading.Lock()
+        self.dropped = 0
+
+    def notify(self, subject, message):
+        try:
+            self._queue.put_nowait((datetime.now(), subject, message))
+        except Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def close(self, timeout=None):
+        """Flushes all pending notifications (ignoring the rate limit) and stops the thread."""
+        self._closing.set()
+        if self.is_alive():
+            try:
+                # wakes the thread up; with a full queue, it is busy anyway and stops once the queue is empty
+                self._queue.put_nowait(Notifier._quit)
+            except Full:
+                pass
+            self.join(timeout)
+        self._disconnect()
+
+    def run(self):
+        pending = []
+        deadline = None
+        while True:
+            try:
+                item = self._queue.get(timeout=(None if deadline is None else max(0.0, deadline - time())))
+            except Empty:
+                item = None
+            if item is not None and item is not Notifier._quit:
+                # while the rate limit holds emails back, the digest must not grow without bounds either
+                if len(pending) < self._max_pending:
+                    pending.append(item)
+                else:
+                    with self._dropped_lock:
+                        self.dropped += 1
+                if deadline is None:
+                    deadline = time() + self._window
+            if self._closing.is_set() and self._queue.empty():
+                if len(pending) > 0:
+                    self._flush(pending)
+                break
+            if deadline is not None and time() >= deadline:
+                next_slot = self._next_slot()
+                if next_slot <= time():
+                    self._flush(pending)
+                    pending = []
+                    deadline = None
+                else:
+                    deadline = next_slot
+
+    def _next_slot(self):
+        while len(self._sent) > 0 and self._sent[0] < time() - 3600:
+            self._sent.popleft()
+        if len(self._sent) < self._max_per_hour:
+            return time()
+        return self._sent[0] + 3600
+
+    def _flush(self, pending):
+        # the thread must outlive any error, as all further notifications would be lost otherwise
+        try:
+            self._send(pending)
+        except:
+            present_error('notifications could not be sent')
+            self._disconnect()
+
+    def _send(self, pending):
+        if len(pending) == 1:
+            subject = pending[0][1]
+        else:
+            subject = '[GeoNewsNet] Digest of %d notifications' % len(pending)
+        message = 'Hi there!\n\n'
+        with self._dropped_lock:
+            (dropped, self.dropped) = (self.dropped, 0)
+        if dropped > 0:
+            message += '(%d further notifications were dropped as too many were waiting)\n\n' % dropped
+        for created, entry_subject, entry_message in pending:
+            message += '%s - %s\n\n%s\n\n' % (created.strftime('%Y-%m-%d %H:%M:%S'), entry_subject, entry_message)
+        msg = compose_email(self._config, subject, message)
+        for attempt in range(2):
+            try:
+                if self._mailer is None:
+                    self._mailer = self._mailer_factory()
+                if self._mailer is not None:
+                    self._mailer.sendmail(msg['From'], msg['To'], msg.as_string())
+                    self._sent.append(time())
+                    return True
+            except (smtplib.SMTPException, OSError):
+                # connection may have been closed by the server in the meantime, so we reconnect once
+                self._disconnect()
+        present_error('notification ("%s") could not be sent' % subject)
+        return False
+
+    def _disconnect(self):
+        if self._mailer is not None:
+            try:
+                self._mailer.quit()
+            except:
+                pass
+            self._mailer = None
+
+
 def check_request(url='https://haim.it'):
     print('- requesting %s' % url)
     header = get_browser_header(config)
@@ -285,6 +634,7 @@ if __name__ == '__main__':
 
     print('Checking config file')
     config = get_config()
+    Link.configure_canonicalization(config)
     print('---------')
 
     print('Checking SMTP/email setup')
@@ -312,6 +662,16 @@ if __name__ == '__main__':
         base.metadata.create_all(engine)
     else:
         print('- database already contains tables, so nothing is created')
+    link_columns = [column['name'] for column in inspector.get_columns('link')]
+    if 'host_origin_uid' not in link_columns or \
+            len(set(link_columns) & {'url_origin', 'fld_origin', 'fld_target'}) > 0:
+        migrate_hosts(engine, db)
+    if url_hashes_incomplete(engine):
+        migrate_url_hashes(engine, db)
+    if 'retries' not in [column['name'] for column in inspector.get_columns('queue')]:
+        print('- adding retry counts to the queue table')
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE queue ADD COLUMN retries INTEGER NOT NULL DEFAULT 0'))
     import_sectors(config, db)
     import_outlets(config, db)
     print('---------')
@@ -1,27 +1,196 @@
 import os
+import csv
 import networkx
+import numpy
+import scipy.sparse
 from decimal import Decimal
 from time import time
 from datetime import datetime
 from collections import Counter
-from setup import get_config, get_engine, get_database
+from setup import get_config, get_engine, get_database, stream_query
 from database import Outlet, Scrape, Link
+from sqlalchemy import func
 import warnings
 
 
+class NetworkMetrics:
+    """Computes network metrics on a sparse weighted adjacency matrix (rows are origins, columns are targets).
+    All computations are vectorized (matrix products rather than loops over nodes or edges), so that page-level
+    graphs with millions of edges can be handled as well as the outlet-level chart.
+    """
+
+    def __init__(self, nodes, origins, targets, weights):
+        self.nodes = list(nodes)
+        n = len(self.nodes)
+        # duplicate (origin, target) pairs are summed up
+        self.adjacency = scipy.sparse.csr_matrix(
+            (numpy.asarray(weights, dtype=float), (numpy.asarray(origins), numpy.asarray(targets))),
+            shape=(n, n)
+        )
+
+    @classmethod
+    def from_edges(cls, origins, targets, weights):
+        """Takes arbitrary node labels for origins and targets (e.g., URLs or host uids)."""
+        origins = numpy.asarray(origins)
+        targets = numpy.asarray(targets)
+        nodes, indices = numpy.unique(numpy.concatenate([origins, targets]), return_inverse=True)
+        return cls(nodes, indices[:len(origins)], indices[len(origins):], weights)
+
+    @classmethod
+    def from_graph(cls, graph, weight='weight'):
+        nodes = list(graph.nodes())
+        index = {node: i for i, node in enumerate(nodes)}
+        m = graph.number_of_edges()
+        origins = numpy.fromiter((index[u] for u, v in graph.edges()), dtype=int, count=m)
+        targets = numpy.fromiter((index[v] for u, v in graph.edges()), dtype=int, count=m)
+        weights = numpy.fromiter((data.get(weight, 1) for u, v, data in graph.edges(data=True)), dtype=float, count=m)
+        return cls(nodes, origins, targets, weights)
+
+    def out_strength(self):
+        return numpy.asarray(self.adjacency.sum(axis=1)).ravel()
+
+    def in_strength(self):
+        return numpy.asarray(self.adjacency.sum(axis=0)).ravel()
+
+    def pagerank(self, alpha=0.85, tol=1e-10, max_iter=100):
+        n = self.adjacency.shape[0]
+        if n == 0:
+            return numpy.zeros(0)
+        out_strength = self.out_strength()
+        dangling = out_strength == 0
+        inverse = numpy.zeros(n)
+        inverse[~dangling] = 1 / out_strength[~dangling]
+        transition = (scipy.sparse.diags(inverse) @ self.adjacency).T.tocsr()
+        rank = numpy.full(n, 1 / n)
+        for i in range(max_iter):
+            previous = rank
+            # rank of dangling nodes as well as teleportation is spread uniformly across all nodes
+            rank = alpha * (transition @ previous) + (alpha * previous[dangling].sum() + 1 - alpha) / n
+            if numpy.abs(rank - previous).sum() < n * tol:
+                break
+        return rank / rank.sum()
+
+    def hits(self, tol=1e-10, max_iter=100):
+        """Returns hub and authority scores, each normalized to sum up to 1."""
+        n = self.adjacency.shape[0]
+        transposed = self.adjacency.T.tocsr()
+        hubs = numpy.full(n, 1 / max(n, 1))
+        authorities = numpy.zeros(n)
+        for i in range(max_iter):
+            previous = hubs
+            authorities = transposed @ hubs
+            authorities = authorities / max(authorities.sum(), 1e-300)
+            hubs = self.adjacency @ authorities
+            hubs = hubs / max(hubs.sum(), 1e-300)
+            if numpy.abs(hubs - previous).sum() < n * tol:
+                break
+        return hubs, authorities
+
+    def reciprocal_weights(self):
+        """Returns a sparse matrix with the weight of the reverse edge at each edge's position (0 if there is none)."""
+        return self.adjacency.T.multiply(self.adjacency != 0).tocsr()
+
+    def weighted_reciprocity(self):
+        """Share of the total weight that is reciprocated, i.e., sum(min(w_ij, w_ji)) / sum(w_ij)."""
+        total = self.adjacency.sum()
+        return self.adjacency.minimum(self.adjacency.T).sum() / total if total > 0 else 0.0
+
+    def mixing_matrix(self, values):
+        """Aggregates edge weights by the (categorical) attribute values of origins and targets.
+        Returns the attribute labels, the matrix of weight shares (rows: origins, columns: targets), and the
+        attribute assortativity coefficient.
+        """
+        labels, codes = numpy.unique(numpy.asarray([str(value) for value in values]), return_inverse=True)
+        membership = scipy.sparse.csr_matrix(
+            (numpy.ones(len(codes)), (numpy.arange(len(codes)), codes)),
+            shape=(len(codes), len(labels))
+        )
+        mixing = (membership.T @ self.adjacency @ membership).toarray()
+        total = mixing.sum()
+        if total == 0:
+            return labels, mixing, float('nan')
+        mixing = mixing / total
+        expected = (mixing.sum(axis=1) * mixing.sum(axis=0)).sum()
+        assortativity = (numpy.trace(mixing) - expected) / (1 - expected) if expected < 1 else float('nan')
+        return labels, mixing, assortativity
+
+
+class GeoMetrics:
+    """Computes great-circle (haversine) distances between nodes from float coordinate arrays (NaN if unknown)
+    in batched NumPy passes, and aggregates link weights by distance and by categorical node attributes.
+    """
+    EARTH_RADIUS_KM = 6371.0088
+
+    def __init__(self, nodes, latitudes, longitudes):
+        self.nodes = list(nodes)
+        self.latitudes = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        self.longitudes = numpy.radians(numpy.asarray(longitudes, dtype=float))
+
+    @staticmethod
+    def haversine(latitudes_origin, longitudes_origin, latitudes_target, longitudes_target):
+        """Expects coordinates in radians (broadcastable arrays) and returns distances in kilometers."""
+        a = numpy.sin((latitudes_target - latitudes_origin) / 2) ** 2 + \
+            numpy.cos(latitudes_origin) * numpy.cos(latitudes_target) * \
+            numpy.sin((longitudes_target - longitudes_origin) / 2) ** 2
+        return 2 * GeoMetrics.EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+    def pairwise_distances(self):
+        """Returns the node-by-node distance matrix in kilometers (NaN for nodes without coordinates)."""
+        return GeoMetrics.haversine(self.latitudes[:, None], self.longitudes[:, None],
+                                    self.latitudes[None, :], self.longitudes[None, :])
+
+    def edge_distances(self, origins, targets):
+        """Takes node indices of edges' origins and targets."""
+        return GeoMetrics.haversine(self.latitudes[origins], self.longitudes[origins],
+                                    self.latitudes[targets], self.longitudes[targets])
+
+    @staticmethod
+    def distance_bins(distances, weights, bins):
+        """Returns the number of edges as well as their summed weights per distance bin (edges without distance
+        are left out).
+        """
+        known = ~numpy.isnan(distances)
+        edges, bins = numpy.histogram(distances[known], bins=bins)
+        weights, bins = numpy.histogram(distances[known], bins=bins, weights=numpy.asarray(weights)[known])
+        return bins, edges, weights
+
+    @staticmethod
+    def flow_matrix(values, origins, targets, weights, distances=None):
+        """Sums edge weights by the (categorical) attribute values of origins and targets.
+        If distances are given, the weighted mean distance per pair of attribute values is returned as well.
+        """
+        labels, codes = numpy.unique(numpy.asarray([str(value) for value in values]), return_inverse=True)
+        k = len(labels)
+        weights = numpy.asarray(weights, dtype=float)
+        pairs = codes[origins] * k + codes[targets]
+        flows = numpy.bincount(pairs, weights=weights, minlength=k * k).reshape(k, k)
+        if distances is None:
+            return labels, flows, None
+        known = ~numpy.isnan(distances)
+        known_flows = numpy.bincount(pairs[known], weights=weights[known], minlength=k * k).reshape(k, k)
+        distance_sums = numpy.bincount(pairs[known], weights=(weights * distances)[known],
+                                       minlength=k * k).reshape(k, k)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean_distances = distance_sums / known_flows
+        return labels, flows, mean_distances
+
+
 class GephiCreator:
     def __init__(self, db):
         self._db = db
         self._graph = networkx.DiGraph()
         self._nodes = []
+        self._hosts = {}
+        self._coordinates = {}
         self._links = []
         self._edges = None
+        self._weighted_reciprocity = None
 
     def _count_internal_links(self, scrape):
-        return self._db.query(Link.url_target).filter(
+        return self._db.query(Link.url_target_hash).filter(
             Link.is_internal,
             Link.scrape_origin == scrape
-        ).group_by(Link.url_target).count()
+        ).group_by(Link.url_target_hash).count()
 
     def _add_single_outlet(self, outlet):
         data_from_outlet = {}
@@ -35,14 +204,19 @@ class GephiCreator:
             warnings.warn('Host %s does not have any internal links, which affects link-ratio calculation' % outlet.fld)
         self._graph.add_node(outlet.fld, **data_from_outlet)
         self._nodes.append(outlet.fld)
+        self._hosts[outlet.host_uid] = outlet.fld
+        self._coordinates[outlet.fld] = (
+            float(outlet.latitude) if outlet.latitude is not None else numpy.nan,
+            float(outlet.longitude) if outlet.longitude is not None else numpy.nan
+        )
 
     def add_outlets(self, outlets):
         for outlet in outlets:
             self._add_single_outlet(outlet)
 
     @staticmethod
-    def get_link_name(link):
-        return '%s -> %s' % (link.fld_origin, link.fld_target)
+    def get_link_name(fld_origin, fld_target):
+        return '%s -> %s' % (fld_origin, fld_target)
 
     @staticmethod
     def get_origin_from_link_name(link_name):
@@ -52,14 +226,15 @@ class GephiCreator:
     def get_target_from_link_name(link_name):
         return link_name.split(' -> ')[1]
 
-    def _add_single_link(self, link):
-        if link.fld_origin in self._nodes and link.fld_target in self._nodes and not link.is_internal:
-            self._edges[GephiCreator.get_link_name(link)] += 1
+    def _add_single_link(self, host_origin_uid, host_target_uid, weight):
+        if host_origin_uid in self._hosts and host_target_uid in self._hosts and host_origin_uid != host_target_uid:
+            self._edges[GephiCreator.get_link_name(self._hosts[host_origin_uid], self._hosts[host_target_uid])] += weight
 
     def add_links(self, links):
+        """Expects (host_origin_uid, host_target_uid, weight) tuples of external links, aggregated per host pair."""
         self._edges = Counter()
-        for link in links:
-            self._add_single_link(link)
+        for host_origin_uid, host_target_uid, weight in links:
+            self._add_single_link(host_origin_uid, host_target_uid, weight)
         for link_name, link_weight in self._edges.most_common():
             link_origin = GephiCreator.get_origin_from_link_name(link_name)
             link_target = GephiCreator.get_target_from_link_name(link_name)
@@ -75,6 +250,80 @@ class GephiCreator:
                     Label=link_name
                 )
 
+    def add_metrics(self, attributes=('area', 'level', 'ownership')):
+        """Attaches strengths, PageRank, and HITS scores to nodes as well as reciprocal weights to edges and computes
+        the graph's weighted reciprocity.
+        Returns a dictionary of attribute-mixing results (labels, matrix, assortativity) per attribute.
+        """
+        metrics = NetworkMetrics.from_graph(self._graph)
+        hubs, authorities = metrics.hits()
+        for key, values in [
+            ('out_strength', metrics.out_strength()),
+            ('in_strength', metrics.in_strength()),
+            ('pagerank', metrics.pagerank()),
+            ('hub', hubs),
+            ('authority', authorities)
+        ]:
+            networkx.set_node_attributes(self._graph, dict(zip(metrics.nodes, values.tolist())), key)
+        reciprocal = metrics.reciprocal_weights()
+        index = {node: i for i, node in enumerate(metrics.nodes)}
+        for origin, target, data in self._graph.edges(data=True):
+            data['reciprocal_weight'] = float(reciprocal[index[origin], index[target]])
+        # GEXF files do not carry graph-level attributes, so this one is available through get_weighted_reciprocity
+        self._weighted_reciprocity = metrics.weighted_reciprocity()
+        mixing = {}
+        for attribute in attributes:
+            mixing[attribute] = metrics.mixing_matrix(
+                [self._graph.nodes[node].get(attribute, '') for node in metrics.nodes]
+            )
+        return mixing
+
+    def add_distances(self, bins=(0, 10, 25, 50, 100, 250, 500, 1000, 2500, 20040), attribute='area'):
+        """Attaches distance_km to all edges between outlets with known coordinates.
+        Returns the distance-binned edge counts and weights, attribute-by-attribute flows, as well as the distances
+        between all pairs of outlets with known coordinates (as labels and matrix).
+        """
+        nodes = list(self._graph.nodes())
+        index = {node: i for i, node in enumerate(nodes)}
+        coordinates = numpy.array([self._coordinates.get(node, (numpy.nan, numpy.nan)) for node in nodes],
+                                  dtype=float).reshape(-1, 2)
+        geo = GeoMetrics(nodes, coordinates[:, 0], coordinates[:, 1])
+        edges = list(self._graph.edges(data=True))
+        origins = numpy.fromiter((index[u] for u, v, data in edges), dtype=int, count=len(edges))
+        targets = numpy.fromiter((index[v] for u, v, data in edges), dtype=int, count=len(edges))
+        weights = numpy.fromiter((data['weight'] for u, v, data in edges), dtype=float, count=len(edges))
+        distances = geo.edge_distances(origins, targets)
+        for (origin, target, data), distance in zip(edges, distances.tolist()):
+            if not numpy.isnan(distance):
+                data['distance_km'] = distance
+        located = ~numpy.isnan(coordinates).any(axis=1)
+        located_nodes = [node for node, is_located in zip(nodes, located.tolist()) if is_located]
+        return (
+            GeoMetrics.distance_bins(distances, weights, bins),
+            GeoMetrics.flow_matrix([self._graph.nodes[node].get(attribute, '') for node in nodes],
+                                   origins, targets, weights, distances),
+            (
+                located_nodes,
+                GeoMetrics(located_nodes, coordinates[located, 0], coordinates[located, 1]).pairwise_distances()
+            )
+        )
+
+    @staticmethod
+    def write_matrix(labels, matrix, file):
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['origin \\ target'] + list(labels))
+            for label, row in zip(labels, matrix):
+                writer.writerow([label] + ['%.6f' % value for value in row])
+
+    @staticmethod
+    def write_distance_bins(bins, edges, weights, file):
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['from_km', 'to_km', 'edges', 'weight'])
+            for i in range(len(edges)):
+                writer.writerow([bins[i], bins[i + 1], edges[i], weights[i]])
+
     def count_links(self):
         return self._graph.number_of_edges()
 
@@ -84,6 +333,9 @@ class GephiCreator:
     def get_outlets(self):
         return self._nodes
 
+    def get_weighted_reciprocity(self):
+        return self._weighted_reciprocity
+
     def write_gexf(self, file):
         networkx.write_gexf(self._graph, file)
 
@@ -107,13 +359,17 @@ if __name__ == '__main__':
     chart.add_outlets(db.query(Outlet).filter(Outlet.scrape_uid.isnot(None)).all())
     print('- %d outlets added to the chart' % chart.count_outlets())
 
-    chart.add_links(db.query(Link).filter(
+    chart.add_links(stream_query(db.query(Link.host_origin_uid, Link.host_target_uid, func.count(Link.uid)).filter(
         Link.scrape_target_uid.isnot(None),
         Link.scrape_origin_uid == Scrape.uid,
         Scrape.status_code == 200,
         Link.is_internal.is_(False)
-    ).all())
+    ).group_by(Link.host_origin_uid, Link.host_target_uid)))
     print('- %d links added to the chart' % chart.count_links())
+    mixing = chart.add_metrics()
+    print('- network metrics added to the chart (weighted reciprocity = %.3f)' % chart.get_weighted_reciprocity())
+    (distance_bins, area_flows, outlet_distances) = chart.add_distances()
+    print('- geographic distances added to the chart')
     print('---------')
 
     print('Storing Gephi chart')
@@ -131,5 +387,21 @@ if __name__ == '__main__':
     print('- attempting to finally create the chart file as %s%s' % (directory, filename))
     chart.write_gexf(directory + filename)
 
+    for attribute, (labels, matrix, assortativity) in mixing.items():
+        mixing_filename = filename.replace('.gexf', '_mixing_%s.csv' % attribute)
+        print('- writing %s mixing matrix (assortativity r = %.3f) to %s%s' %
+              (attribute, assortativity, directory, mixing_filename))
+        GephiCreator.write_matrix(labels, matrix, directory + mixing_filename)
+
+    print('- writing distance-binned link flows to %s%s' % (directory, filename.replace('.gexf', '_distances.csv')))
+    GephiCreator.write_distance_bins(*distance_bins, directory + filename.replace('.gexf', '_distances.csv'))
+    (labels, flows, mean_distances) = area_flows
+    print('- writing area-by-area link flows to %s%s' % (directory, filename.replace('.gexf', '_area_flows.csv')))
+    GephiCreator.write_matrix(labels, flows, directory + filename.replace('.gexf', '_area_flows.csv'))
+    GephiCreator.write_matrix(labels, mean_distances, directory + filename.replace('.gexf', '_area_distances.csv'))
+    print('- writing outlet-by-outlet distances to %s%s' %
+          (directory, filename.replace('.gexf', '_outlet_distances.csv')))
+    GephiCreator.write_matrix(*outlet_distances, directory + filename.replace('.gexf', '_outlet_distances.csv'))
+
     print('---------')
     print('Done in %.2f seconds' % (time() - t0))